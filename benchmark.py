@@ -0,0 +1,417 @@
+import argparse
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import abspath, dirname, join
+from urllib.parse import parse_qs, urlsplit
+
+from filter_posts import CombineJSONs, FilterPosts
+from get_posts import MultiProfileExtractor, StarTVClient, TokenGenerator
+from metrics import metrics
+from post_store import PostSink
+from request_maker import RateLimiter, RequestMaker
+from utils import JSONCodec, JSONUtils, OSFileOperations
+
+# Modules importing the extraction and report code must not load, they are only needed once requests are made.
+DEFERRED_MODULES = ('aiohttp', 'requests', 'tldextract', 'urllib3')
+# Times one import in a fresh interpreter, printing the seconds and any deferred modules it loaded.
+IMPORT_SCRIPT = '''
+import sys, time
+sys.path.insert(0, {package_dir!r})
+started_at = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - started_at
+print(seconds, *(module for module in {deferred_modules!r} if module in sys.modules))
+'''
+
+
+class SyntheticPosts:
+    """ Posts shaped like those of the SocialStudio API, generated deterministically per profile"""
+    LINKS = ['https://twitter.com/{}/status/{}', 'https://www.facebook.com/{}/posts/{}',
+             'https://www.youtube.com/watch?v={}{}', 'http://news.bbc.co.uk/{}/{}',
+             'https://{}.blogspot.com/{}', 'https://www.instagram.com/p/{}{}', 'http://forum.example.com.au/{}/{}']
+    POST_TYPES = [None, None, None, 'COMMENT', 'REPLY', 'RETWEET', '']
+    WORDS = ['launch', 'episode', 'tonight', 'watch', 'live', 'finale', 'season', 'star', 'tv', 'show', 'great', 'new']
+    DAY_MILLIS = 24 * 60 * 60 * 1000
+    # Posts are spread over this many days up to today, inside the window get_posts extracts by default.
+    DAYS = 90
+
+    @staticmethod
+    def generate(profile_id, count, first_index=0, seed=0):
+        start_date = (int(time.time() * 1000) // SyntheticPosts.DAY_MILLIS - SyntheticPosts.DAYS) * SyntheticPosts.DAY_MILLIS
+        for index in range(first_index, first_index + count):
+            yield SyntheticPosts.get_post(profile_id, index, count + first_index, start_date, seed)
+
+    @staticmethod
+    def get_post(profile_id, index, total, start_date, seed=0):
+        rnd = random.Random('{}-{}-{}'.format(seed, profile_id, index))
+        author = 'user{}'.format(rnd.randrange(5000))
+        post_type = rnd.choice(SyntheticPosts.POST_TYPES)
+        has_parent = post_type in ('COMMENT', 'REPLY')
+        return {'id': '{}{:010d}'.format(profile_id, index),
+                'title': ' '.join(rnd.choice(SyntheticPosts.WORDS) for _ in range(rnd.randrange(3, 9))),
+                'content': ' '.join(rnd.choice(SyntheticPosts.WORDS) for _ in range(rnd.randrange(60)))
+                if rnd.random() < 0.6 else '',
+                'externalLink': rnd.choice(SyntheticPosts.LINKS).format(author, index),
+                'publishedDate': start_date + SyntheticPosts.DAYS * SyntheticPosts.DAY_MILLIS * index // max(total, 1),
+                'postType': post_type,
+                'parent': {'id': '{}{:010d}'.format(profile_id, rnd.randrange(index + 1))} if has_parent else None,
+                'language': rnd.choice(['en', 'en', 'en', 'es', 'fr']),
+                'author': {'authorFullName': author.title() if rnd.random() < 0.7 else '',
+                           'authorName': author,
+                           'avatar': 'https://img.example.com/{}.jpg'.format(author) if rnd.random() < 0.8 else None},
+                'postDynamics': [{'label': 'likes', 'value': str(rnd.choice([0, 0, 0, rnd.randrange(500)]))},
+                                 {'label': 'shares', 'value': str(rnd.choice([0, 0, rnd.randrange(50)]))}],
+                'topics': [int(profile_id)]}
+
+    @staticmethod
+    def write_dump(dump_file, posts):
+        """ Write `posts` to a legacy `{'data': [...], 'meta': {...}}` dump without holding them in memory"""
+        sink = PostSink('{}.ndjson'.format(dump_file))
+        sink.rollback(0, 0)
+        batch = []
+        for post in posts:
+            batch.append(post)
+            if len(batch) >= 10000:
+                sink.append(batch)
+                batch = []
+        sink.append(batch)
+        sink.export(dump_file)
+        OSFileOperations.remove_entity(sink.data_file)
+        OSFileOperations.remove_entity(sink.meta_file)
+
+
+class MockSocialStudioAPI:
+    """
+    Local stand-in for the `/oauth/token` and `/v3/posts` endpoints, serving
+    SyntheticPosts with the pagination of the real API. Every request waits
+    `latency` seconds and is answered 429 with probability `throttle_rate`.
+    """
+
+    def __init__(self, posts_per_profile=5000, latency=0.0, throttle_rate=0.0, retry_after=0, seed=0):
+        self.posts_per_profile = posts_per_profile
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.seed = seed
+        self.random = random.Random(seed)
+        # profile_id -> (posts, {post id: position})
+        self.profiles = {}
+        self.counters = Counter()
+        self.lock = threading.Lock()
+        self.server = None
+
+    def start(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), MockAPIHandler)
+        self.server.daemon_threads = True
+        self.server.api = self
+        threading.Thread(target=self.server.serve_forever, name='mock-api', daemon=True).start()
+        return 'http://127.0.0.1:{}'.format(self.server.server_port)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_counters(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def is_throttled(self):
+        with self.lock:
+            throttled = self.random.random() < self.throttle_rate
+            if throttled:
+                self.counters['throttled'] += 1
+            return throttled
+
+    def get_token(self):
+        with self.lock:
+            self.counters['tokens'] += 1
+            return {'access_token': 'token-{}'.format(self.counters['tokens']),
+                    'refresh_token': 'refresh-token',
+                    'expires_in': 3600}
+
+    def get_page(self, query):
+        posts, positions = self.get_profile(query['topics'])
+        start = 0
+        if 'sinceId' in query:
+            start = positions[query['sinceId']] + 1
+        start_date = int(query.get('startDate', 0))
+        end_date = int(query['endDate']) if 'endDate' in query else None
+        while start < len(posts) and posts[start]['publishedDate'] < start_date:
+            start += 1
+        end = len(posts)
+        while end_date is not None and end > start and posts[end - 1]['publishedDate'] >= end_date:
+            end -= 1
+        data = posts[start:min(end, start + int(query.get('limit', 1000)))]
+        with self.lock:
+            self.counters['pages'] += 1
+            self.counters['posts'] += len(data)
+        return {'data': data, 'meta': {'totalCount': end - start}}
+
+    def get_profile(self, profile_id):
+        with self.lock:
+            if profile_id not in self.profiles:
+                posts = list(SyntheticPosts.generate(profile_id, self.posts_per_profile, seed=self.seed))
+                self.profiles[profile_id] = (posts, {post['id']: position for position, post in enumerate(posts)})
+            return self.profiles[profile_id]
+
+
+class MockAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self._respond(self.server.api.get_token)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path != '/v3/posts':
+            self._send(404, {'error': 'not found'})
+            return
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        self._respond(lambda: self.server.api.get_page(query))
+
+    def _respond(self, get_body):
+        api = self.server.api
+        if api.latency:
+            time.sleep(api.latency)
+        if api.is_throttled():
+            self._send(429, {'error': 'too many requests'}, {'Retry-After': str(api.retry_after)})
+            return
+        self._send(200, get_body())
+
+    def _send(self, status, body, headers=None):
+        content = JSONCodec.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def extract_profiles(base_url, profile_ids, workers, rate):
+    # Per stage timings of the extraction loop, returned with the results.
+    metrics.enable()
+    request_maker = RequestMaker(rate_limiter=RateLimiter(rate=rate, burst=workers), pool_size=workers + 1)
+    token_generator = TokenGenerator(client_info=StarTVClient(), request_maker=request_maker, base_url=base_url)
+    failed_profiles = MultiProfileExtractor(token_generator, request_maker, workers=workers).write_api_data(profile_ids)
+    return {'failedProfiles': failed_profiles, 'requests': request_maker.stats.to_dict(),
+            'metrics': metrics.snapshot()}
+
+
+def filter_dump(dump_file, columnar=False):
+    if columnar:
+        FilterPosts().execute_columnar(dump_file)
+    else:
+        FilterPosts().execute_streaming(dump_file)
+    return {}
+
+
+def combine_dumps(dump_files, output_dir, workers):
+    topic_counts = CombineJSONs().combine_to_sinks(dump_files, output_dir, workers=workers)
+    return {'topicCounts': {str(topic_id): count for topic_id, count in topic_counts.items()}}
+
+
+def _measure(function, args):
+    started_at = time.perf_counter()
+    # The extraction and reports print progress per page, which would drown the benchmark's own output.
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        result = function(*args)
+    result['seconds'] = time.perf_counter() - started_at
+    # kilobytes on Linux; children are CombineJSONs' worker processes
+    result['peakRssKb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result['peakChildRssKb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return result
+
+
+def run_stage(name, function, *args):
+    """ Run one stage in a fresh interpreter, so its timings and peak RSS are not skewed by earlier stages"""
+    print('Running {} ...'.format(name))
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(_measure, function, args).result()
+
+
+def get_git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=dirname(abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark_extraction(args):
+    api = MockSocialStudioAPI(posts_per_profile=args.posts_per_profile, latency=args.latency,
+                              throttle_rate=args.throttle_rate, retry_after=args.retry_after, seed=args.seed)
+    base_url = api.start()
+    JSONUtils.write_json_data_to_file('credentials.json', {'client_id': 'benchmark', 'client_secret': 'benchmark',
+                                                           'username': 'benchmark', 'password': 'benchmark'})
+    profile_ids = [str(1000000 + profile) for profile in range(args.profiles)]
+    # Posts are generated up front, so the stage only measures serving them.
+    for profile_id in profile_ids:
+        api.get_profile(profile_id)
+    served_before = api.get_counters()
+    try:
+        result = run_stage('extract', extract_profiles, base_url, profile_ids, args.workers, args.rate)
+    finally:
+        api.stop()
+    served = Counter(api.get_counters())
+    served.subtract(served_before)
+    result['pages'] = served['pages']
+    result['posts'] = served['posts']
+    result['throttled'] = served['throttled']
+    result['pagesPerSecond'] = result['pages'] / result['seconds']
+    result['postsPerSecond'] = result['posts'] / result['seconds']
+    return result
+
+
+def benchmark_filtering(args, columnar=False):
+    dump_file = join('dumps', 'filter', 'posts_{}.json'.format(args.dump_posts))
+    if not OSFileOperations.entity_exists(dump_file):
+        SyntheticPosts.write_dump(dump_file, SyntheticPosts.generate('2000000', args.dump_posts, seed=args.seed))
+    result = run_stage('filter-columnar' if columnar else 'filter', filter_dump, dump_file, columnar)
+    result['posts'] = args.dump_posts
+    result['bytes'] = OSFileOperations.get_file_size(dump_file)
+    result['postsPerSecond'] = args.dump_posts / result['seconds']
+    return result
+
+
+def benchmark_combining(args):
+    # Files alternate between two topics and overlap their predecessor of the same topic by a quarter.
+    posts_per_file = max(args.dump_posts // args.combine_files, 1)
+    dump_files = []
+    for file_number in range(args.combine_files):
+        profile_id = str(3000000 + file_number % 2)
+        first_index = (file_number // 2) * posts_per_file * 3 // 4
+        dump_file = join('dumps', 'combine', 'posts_{}_{}.json'.format(profile_id, file_number))
+        SyntheticPosts.write_dump(dump_file, SyntheticPosts.generate(profile_id, posts_per_file,
+                                                                     first_index=first_index, seed=args.seed))
+        dump_files.append(dump_file)
+    output_dir = join('combined', str(time.time()))
+    result = run_stage('combine', combine_dumps, dump_files, output_dir, args.workers)
+    result['files'] = len(dump_files)
+    result['posts'] = posts_per_file * len(dump_files)
+    result['postsPerSecond'] = result['posts'] / result['seconds']
+    return result
+
+
+def measure_import(module):
+    """ Seconds importing `module` takes in a fresh interpreter and the deferred modules it loaded"""
+    script = IMPORT_SCRIPT.format(package_dir=dirname(abspath(__file__)), module=module,
+                                  deferred_modules=DEFERRED_MODULES)
+    # Run from the work dir, which has no credentials.json unless the extract stage wrote one.
+    output = subprocess.check_output([sys.executable, '-c', script]).decode().split()
+    return float(output[0]), output[1:]
+
+
+def benchmark_startup(args):
+    print('Running startup ...')
+    result = {'budgetMs': args.import_budget_ms, 'modules': {}}
+    for module in ('get_posts', 'filter_posts'):
+        # The median of several runs, the first ones also pay for writing bytecode caches.
+        timings, loaded_modules = [], set()
+        for _ in range(args.import_runs):
+            seconds, loaded = measure_import(module)
+            timings.append(seconds)
+            loaded_modules.update(loaded)
+        result['modules'][module] = {'importMs': statistics.median(timings) * 1000,
+                                     'deferredModulesLoaded': sorted(loaded_modules)}
+    result['withinBudget'] = all(timing['importMs'] <= args.import_budget_ms and not timing['deferredModulesLoaded']
+                                 for timing in result['modules'].values())
+    return result
+
+
+def print_results(results):
+    print('{:<16}{:>10}{:>14}{:>14}{:>14}'.format('stage', 'seconds', 'pages/s', 'posts/s', 'peak RSS MB'))
+    for name, result in results['stages'].items():
+        if name == 'startup':
+            continue
+        pages_per_second = result.get('pagesPerSecond')
+        print('{:<16}{:>10.2f}{:>14}{:>14.0f}{:>14.1f}'.format(
+            name, result['seconds'], '{:.1f}'.format(pages_per_second) if pages_per_second else '-',
+            result['postsPerSecond'], result['peakRssKb'] / 1024))
+    startup = results['stages'].get('startup')
+    if startup:
+        for module, timing in startup['modules'].items():
+            print('import {:<16}{:>8.1f} ms (budget {} ms){}'.format(
+                module, timing['importMs'], startup['budgetMs'],
+                ', loaded {}'.format(', '.join(timing['deferredModulesLoaded']))
+                if timing['deferredModulesLoaded'] else ''))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure startup time and extraction, filtering and combining throughput '
+                                                 'against a local mock of the SocialStudio API.')
+    parser.add_argument('--stages', default='startup,extract,filter,filter-columnar,combine',
+                        help='Comma separated stages to run.')
+    parser.add_argument('--profiles', type=int, default=4, help='Profiles served by the mock API.')
+    parser.add_argument('--posts-per-profile', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=4, help='Concurrent profiles and CombineJSONs processes.')
+    parser.add_argument('--rate', type=float, help='Requests per second allowed by the rate limiter, unlimited by default.')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds the mock API takes per request.')
+    parser.add_argument('--throttle-rate', type=float, default=0.02,
+                        help='Share of requests the mock API answers with 429.')
+    parser.add_argument('--retry-after', type=float, default=0, help='Retry-After sent with 429 responses.')
+    parser.add_argument('--dump-posts', type=int, default=100000,
+                        help='Posts of the synthetic dump filtered, and in total of the dumps combined.')
+    parser.add_argument('--combine-files', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--import-budget-ms', type=float, default=150,
+                        help='Longest import of get_posts or filter_posts the startup stage accepts.')
+    parser.add_argument('--import-runs', type=int, default=5, help='Fresh interpreters each import is timed in.')
+    parser.add_argument('--work-dir', help='Keep the generated files here instead of a temporary directory.')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON file the results are written to.')
+    args = parser.parse_args()
+    output_file = abspath(args.output)
+    work_dir = abspath(args.work_dir) if args.work_dir else tempfile.mkdtemp(prefix='benchmark_')
+    os.makedirs(work_dir, exist_ok=True)
+    current_dir = os.getcwd()
+    os.chdir(work_dir)
+    stage_runners = {'startup': benchmark_startup,
+                     'extract': benchmark_extraction,
+                     'filter': benchmark_filtering,
+                     'filter-columnar': lambda args: benchmark_filtering(args, columnar=True),
+                     'combine': benchmark_combining}
+    results = {'startedAt': datetime.now().isoformat(),
+               'gitRevision': get_git_revision(),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'cpuCount': os.cpu_count(),
+               'parameters': {key: value for key, value in vars(args).items() if key not in ('output', 'work_dir')},
+               'stages': {}}
+    try:
+        for stage in args.stages.split(','):
+            if stage not in stage_runners:
+                parser.error('unknown stage: {}'.format(stage))
+            results['stages'][stage] = stage_runners[stage](args)
+    finally:
+        os.chdir(current_dir)
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    JSONUtils.write_json_data_to_file(output_file, results)
+    print_results(results)
+    print('Results written to {}'.format(output_file))
+    if not results['stages'].get('startup', {}).get('withinBudget', True):
+        sys.exit('Importing get_posts or filter_posts exceeds the startup budget')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,370 @@
-from collections import defaultdict
+import argparse
+import os
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from fnmatch import fnmatch
+from functools import lru_cache
+from itertools import islice
+from operator import itemgetter
+from os.path import basename, getmtime, join
+from urllib.parse import urlsplit
 
-import tldextract
+from post_archive import PostArchive
+from post_columns import PostColumns, PostFlags, has_dynamics
+from post_store import PostIndex, PostReader, PostSink
+from utils import FileManifest, JSONCodec, JSONUtils, LazyModule, OSFileOperations
 
-from utils import JSONUtils
+tldextract = LazyModule('tldextract')
+
+# Full dumps of get_posts, e.g. start_tv_posts_2/<profile>/posts_<profile>.json, not the with/without content splits.
+POSTS_FILE_PATTERN = 'posts_[0-9]*.json'
+
+
+class DomainResolver:
+    """
+    Resolves the registered domain name of urls. Only the Public Suffix List
+    snapshot bundled with tldextract is used, it is never fetched over the
+    network, and results are cached per netloc since posts share few hosts.
+    """
+
+    def __init__(self, cache_size=4096):
+        # Created with the first lookup, so reports over columns never load tldextract.
+        self.extractor = None
+        self._get_netloc_domain = lru_cache(maxsize=cache_size)(self._extract_domain)
+
+    def get_domain(self, url):
+        return self._get_netloc_domain(self._get_netloc(url))
+
+    def get_domains(self, urls):
+        """ Resolve a whole column of urls, extracting every distinct netloc once"""
+        netlocs = [self._get_netloc(url) for url in urls]
+        domains = {netloc: self._get_netloc_domain(netloc) for netloc in set(netlocs)}
+        return [domains[netloc] for netloc in netlocs]
+
+    def _extract_domain(self, netloc):
+        if self.extractor is None:
+            self.extractor = tldextract.TLDExtract(suffix_list_urls=())
+        return self.extractor(netloc).domain
+
+    @staticmethod
+    def _get_netloc(url):
+        if not url:
+            return ''
+        netloc = urlsplit(url).netloc
+        if netloc:
+            return netloc
+        # urls without a scheme, e.g. 'www.example.com/path'
+        return url.split('/', 1)[0]
+
+
+domain_resolver = DomainResolver()
 
 
 def get_domain(url):
-    list_2 = tldextract.extract(url)
-    domain_name = list_2.domain
-    return domain_name
+    return domain_resolver.get_domain(url)
+
+
+class PostBreakup:
+    """
+    Counters behind the FilterPosts report, filled one post at a time so a dump
+    is reported on in a single pass, keeping only one count per domain and post
+    type in memory.
+    """
+
+    COUNT_FIELDS = ('total_posts', 'posts_with_content', 'root_posts', 'root_posts_with_post_type', 'comments',
+                    'posts_with_author_name', 'posts_with_avatar', 'original_posts_with_dynamics')
+    COUNTER_FIELDS = ('domain_counts', 'post_type_counts', 'domain_dynamics_counts')
+
+    def __init__(self):
+        self.profile_id = None
+        self.total_posts = 0
+        self.posts_with_content = 0
+        self.root_posts = 0
+        self.root_posts_with_post_type = 0
+        self.comments = 0
+        self.posts_with_author_name = 0
+        self.posts_with_avatar = 0
+        self.original_posts_with_dynamics = 0
+        # Counters keep first-seen order, which decides the order of equal counts in the report.
+        self.domain_counts = Counter()
+        self.post_type_counts = Counter()
+        self.domain_dynamics_counts = Counter()
+
+    def add(self, post):
+        if self.profile_id is None:
+            self.profile_id = post['topics'][0]
+        self.add_group(post['postType'], get_domain(post['externalLink']), PostFlags.of(post))
+
+    def add_group(self, post_type, domain, flags, count=1):
+        """ Count `count` posts sharing `post_type`, `domain` and the PostFlags bits `flags`"""
+        self.total_posts += count
+        self.domain_counts[domain] += count
+        self.post_type_counts[post_type] += count
+        if flags & PostFlags.CONTENT:
+            self.posts_with_content += count
+        if flags & PostFlags.ROOT:
+            self.root_posts += count
+            if post_type:
+                self.root_posts_with_post_type += count
+        if flags & PostFlags.AUTHOR_NAME:
+            self.posts_with_author_name += count
+        if flags & PostFlags.AVATAR:
+            self.posts_with_avatar += count
+        if post_type is None:
+            if flags & PostFlags.PARENT:
+                self.comments += count
+            if flags & PostFlags.DYNAMICS:
+                self.original_posts_with_dynamics += count
+                self.domain_dynamics_counts[domain] += count
+
+    def merge(self, other):
+        """ Add the counts of `other`, as if its posts had been added after the ones counted here"""
+        if self.profile_id is None:
+            self.profile_id = other.profile_id
+        for field in self.COUNT_FIELDS:
+            setattr(self, field, getattr(self, field) + getattr(other, field))
+        for field in self.COUNTER_FIELDS:
+            getattr(self, field).update(getattr(other, field))
+        return self
+
+    def to_dict(self):
+        breakup = {'profile_id': self.profile_id}
+        for field in self.COUNT_FIELDS:
+            breakup[field] = getattr(self, field)
+        for field in self.COUNTER_FIELDS:
+            # [key, count] pairs, since domains and post types may be None and their order matters.
+            breakup[field] = [[key, count] for key, count in getattr(self, field).items()]
+        return breakup
+
+    @staticmethod
+    def from_dict(breakup_dict):
+        breakup = PostBreakup()
+        breakup.profile_id = breakup_dict['profile_id']
+        for field in PostBreakup.COUNT_FIELDS:
+            setattr(breakup, field, breakup_dict[field])
+        for field in PostBreakup.COUNTER_FIELDS:
+            setattr(breakup, field, Counter({key: count for key, count in breakup_dict[field]}))
+        return breakup
+
+    @staticmethod
+    def from_columns(columns):
+        breakup = PostBreakup()
+        breakup.profile_id = columns.profile_id
+        for (post_type, domain, flags), count in columns.group_counts().items():
+            breakup.add_group(post_type, domain, flags, count)
+        return breakup
+
+
+class ReportState:
+    """
+    The PostBreakup of every posts file of a profile reported on before, with
+    how far the file was read: the byte offset of an NDJSON sink, the chunks
+    of a PostArchive, or the size and mtime of a legacy dump. Sinks and
+    archives only grow, so `update` folds in the posts appended since; a file
+    that was rewritten or truncated instead is counted again from the start.
+    """
+    VERSION = 1
+    # Bytes before the offset of a sink kept to notice it was rewritten.
+    TAIL_BYTES = 32
+
+    def __init__(self, state_file):
+        self.state_file = state_file
+        # posts file -> {'kind': ..., position fields of that kind, 'breakup': PostBreakup.to_dict()}
+        self.sources = dict()
+        if OSFileOperations.entity_exists(state_file):
+            state = JSONUtils.load_json_data_from_file(state_file)
+            if state.get('version') == self.VERSION:
+                self.sources = state['sources']
+
+    def update(self, posts_files):
+        """ Bring the state up to date with `posts_files`, returning their merged PostBreakup and the posts added"""
+        sources, breakup, new_posts = dict(), PostBreakup(), 0
+        for posts_file in posts_files:
+            if PostArchive.exists(posts_file):
+                source, source_breakup, source_new_posts = self._update_archive(posts_file,
+                                                                                self.sources.get(posts_file))
+            elif not OSFileOperations.entity_exists(posts_file):
+                continue
+            elif posts_file.endswith('.ndjson'):
+                source, source_breakup, source_new_posts = self._update_sink(posts_file, self.sources.get(posts_file))
+            else:
+                source, source_breakup, source_new_posts = self._update_dump(posts_file, self.sources.get(posts_file))
+            source['breakup'] = source_breakup.to_dict()
+            sources[posts_file] = source
+            breakup.merge(source_breakup)
+            new_posts += source_new_posts
+        self.sources = sources
+        return breakup, new_posts
+
+    def save(self):
+        JSONUtils.write_json_data_to_file(self.state_file, {'version': self.VERSION, 'sources': self.sources})
+
+    def _update_sink(self, sink_file, source):
+        offset, breakup = 0, PostBreakup()
+        if source and source['kind'] == 'ndjson' and self._get_tail(sink_file, source['offset']) == source['tail']:
+            offset, breakup = source['offset'], PostBreakup.from_dict(source['breakup'])
+        new_posts = 0
+        with open(sink_file, 'rb') as file:
+            file.seek(offset)
+            for line in file:
+                if not line.endswith(b'\n'):
+                    # A post still being appended, it is counted by the next update.
+                    break
+                offset += len(line)
+                if line.strip():
+                    breakup.add(JSONCodec.loads(line))
+                    new_posts += 1
+        return {'kind': 'ndjson', 'offset': offset, 'tail': self._get_tail(sink_file, offset)}, breakup, new_posts
+
+    def _update_archive(self, archive_dir, source):
+        archive = PostArchive(archive_dir)
+        chunk_ids = [[entry['file'], entry['count'], entry['firstId'], entry['lastId']]
+                     for entry in archive.index['chunks']]
+        folded_chunks, breakup = 0, PostBreakup()
+        if source and source['kind'] == 'archive' and chunk_ids[:len(source['chunks'])] == source['chunks']:
+            folded_chunks, breakup = len(source['chunks']), PostBreakup.from_dict(source['breakup'])
+        new_posts = 0
+        for chunk in archive.chunks[folded_chunks:]:
+            for post in chunk.iter_posts():
+                breakup.add(post)
+                new_posts += 1
+        return {'kind': 'archive', 'chunks': chunk_ids}, breakup, new_posts
+
+    def _update_dump(self, json_file, source):
+        stat = os.stat(json_file)
+        position = {'kind': 'json', 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+        if source and all(source.get(key) == value for key, value in position.items()):
+            return position, PostBreakup.from_dict(source['breakup']), 0
+        # Legacy dumps are rewritten as a whole.
+        breakup, new_posts = PostBreakup(), 0
+        for post in PostReader.iter_posts(json_file):
+            breakup.add(post)
+            new_posts += 1
+        return position, breakup, new_posts
+
+    def _get_tail(self, sink_file, offset):
+        """ Hex of the bytes before `offset`, None if the file is shorter"""
+        if OSFileOperations.get_file_size(sink_file) < offset:
+            return None
+        with open(sink_file, 'rb') as file:
+            file.seek(max(offset - self.TAIL_BYTES, 0))
+            return file.read(min(offset, self.TAIL_BYTES)).hex()
+
+
+def _load_serialized_posts(json_file):
+    """ Topics of `json_file` and its posts as (id, serialized post) pairs, run in CombineJSONs worker processes"""
+    topic_ids, posts = [], []
+    for post in PostReader.iter_posts(json_file):
+        if not topic_ids:
+            topic_ids = post['topics']
+        posts.append((post['id'], JSONCodec.dumps(post)))
+    return topic_ids, posts
+
+
+def get_profile_sources(input_dir, profile_ids=None):
+    """
+    profile id -> the posts files FilterPosts reports on for each profile
+    directory of a get_posts output tree like start_tv_posts_2: its NDJSON
+    sinks, else its archive, else its legacy dump
+    """
+    profile_sources = dict()
+    profile_dirs = sorted(OSFileOperations.iter_dirs(input_dir, recursive=False))
+    for profile_dir in profile_dirs:
+        profile_id = basename(profile_dir)
+        if profile_ids and profile_id not in profile_ids:
+            continue
+        # Named as get_posts.FileComponents names them.
+        sinks = [join(profile_dir, 'with_content', 'posts_with_{}.ndjson'.format(profile_id)),
+                 join(profile_dir, 'without_content', 'posts_without_{}.ndjson'.format(profile_id))]
+        archive_dir = join(profile_dir, 'posts_{}.archive'.format(profile_id))
+        dump_file = join(profile_dir, 'posts_{}.json'.format(profile_id))
+        if any(OSFileOperations.entity_exists(sink) for sink in sinks):
+            profile_sources[profile_id] = sinks
+        elif PostArchive.exists(archive_dir):
+            profile_sources[profile_id] = [archive_dir]
+        elif OSFileOperations.entity_exists(dump_file):
+            profile_sources[profile_id] = [dump_file]
+    return profile_sources
+
+
+def _update_profile_report(state_file, posts_files):
+    """ Fold the posts added to `posts_files` into the saved report state, run in FilterPosts worker processes"""
+    state = ReportState(state_file)
+    breakup, new_posts = state.update(posts_files)
+    state.save()
+    return breakup.to_dict(), new_posts
+
+
+def get_posts_files(input_dir, pattern=POSTS_FILE_PATTERN, manifest=None, workers=None):
+    """
+    Posts files below `input_dir` whose name matches `pattern`, sorted. With a
+    FileManifest only files added or modified since its last scan are returned;
+    the caller saves the manifest once they are processed.
+    """
+    if manifest is None:
+        files = OSFileOperations.iter_files(input_dir, workers=workers)
+    else:
+        changes = manifest.scan(input_dir, workers=workers)
+        files = changes['added'] + changes['modified']
+    return sorted(file for file in files if fnmatch(basename(file), pattern))
 
 
 class CombineJSONs:
+    def __init__(self, index_dir=None):
+        # Without an index_dir duplicates are only dropped within a single run.
+        self.index_dir = index_dir
+        self.topic_indexes = dict()
+
+    def combine_to_sinks(self, list_of_files, output_dir, workers=None, export=True):
+        """
+        Merge posts files into one sink per topic under `output_dir`. Files are
+        parsed in a process pool, and at most two results per worker are held in
+        memory while they are written out. Returns the number of posts per topic.
+        """
+        workers = workers if workers else os.cpu_count()
+        topic_sinks = dict()
+        pending_files = iter(list_of_files)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # Results are consumed in input order, so the first copy of a duplicated post is the one kept.
+            futures = deque(executor.submit(_load_serialized_posts, json_file)
+                            for json_file in islice(pending_files, 2 * workers))
+            while futures:
+                topic_ids, posts = futures.popleft().result()
+                self._write_to_topic_sinks(topic_sinks, output_dir, topic_ids, posts)
+                for json_file in islice(pending_files, 1):
+                    futures.append(executor.submit(_load_serialized_posts, json_file))
+        if export:
+            for topic_id, sink in topic_sinks.items():
+                sink.export(join(output_dir, str(topic_id), 'posts_{}.json'.format(topic_id)))
+        return {topic_id: sink.count for topic_id, sink in topic_sinks.items()}
+
+    def combine_dir(self, input_dir, output_dir, manifest_file=None, pattern=POSTS_FILE_PATTERN, workers=None):
+        """
+        `combine_to_sinks` over the posts files below `input_dir`. With a
+        `manifest_file`, a rerun only combines files added or modified since the
+        previous one, relying on the topic indexes to skip posts seen before.
+        """
+        manifest = FileManifest(manifest_file) if manifest_file else None
+        posts_files = get_posts_files(input_dir, pattern=pattern, manifest=manifest, workers=workers)
+        print('Combining {} posts files from {}'.format(len(posts_files), input_dir))
+        topic_counts = self.combine_to_sinks(posts_files, output_dir, workers=workers)
+        if manifest:
+            manifest.save()
+        return topic_counts
+
+    def _write_to_topic_sinks(self, topic_sinks, output_dir, topic_ids, posts):
+        for topic_id in topic_ids:
+            topic_index = self._get_topic_index(topic_id)
+            if topic_id not in topic_sinks:
+                sink_file = join(output_dir, str(topic_id), 'posts_{}.ndjson'.format(topic_id))
+                topic_sinks[topic_id] = PostSink(sink_file)
+                if topic_sinks[topic_id].count and not len(topic_index):
+                    # Appending to the output of an earlier run without a persistent index.
+                    topic_index.seed(topic_sinks[topic_id].iter_posts())
+            new_posts = topic_index.filter_new(posts, get_id=itemgetter(0))
+            topic_sinks[topic_id].append_lines([line for _, line in new_posts])
+            topic_index.add(post_id for post_id, _ in new_posts)
+
     def combine_jsons(self, list_of_files):
         json_map = self._load_jsons(list_of_files)
         topic_json_map = self._club_jsons(json_map)
@@ -29,19 +382,28 @@ class CombineJSONs:
         for json_data in json_map.values():
             topic_ids = json_data['data'][0]['topics']
             for topic_id in topic_ids:
+                topic_index = self._get_topic_index(topic_id)
+                data_list = topic_index.filter_new(json_data['data'])
+                topic_index.add(post['id'] for post in data_list)
                 if topic_id not in topic_json_map:
                     topic_json_map[topic_id] = {
-                        'data': json_data['data'],
-                        'meta': json_data['meta']
+                        'data': data_list,
+                        'meta': {'totalCount': len(data_list)}
                     }
                 else:
-                    data_list = json_data['data']
-                    existing_data_list = topic_json_map[topic_id]['data']
-                    total_data = existing_data_list + data_list
-                    topic_json_map[topic_id]['data'] = total_data,
-                    topic_json_map[topic_id]['meta']['totalCount'] += json_data['meta']['totalCount']
+                    topic_json_map[topic_id]['data'].extend(data_list)
+                    topic_json_map[topic_id]['meta']['totalCount'] += len(data_list)
         return topic_json_map
 
+    def _get_topic_index(self, topic_id):
+        if topic_id not in self.topic_indexes:
+            if self.index_dir:
+                index_file = join(self.index_dir, 'seen_{}.sqlite'.format(topic_id))
+            else:
+                index_file = ':memory:'
+            self.topic_indexes[topic_id] = PostIndex(index_file)
+        return self.topic_indexes[topic_id]
+
 
 class FilterPosts:
     def execute(self, input_file):
@@ -49,6 +411,75 @@ class FilterPosts:
         posts = json_data['data']
         self._get_breakup(posts)
 
+    def execute_streaming(self, input_file, start_date=None, end_date=None):
+        """
+        Same report as `execute`, computed in one pass without loading
+        `input_file` into memory, optionally over the posts published in
+        [start_date, end_date) only
+        """
+        breakup = PostBreakup()
+        for post in PostReader.iter_posts(input_file, start_date=start_date, end_date=end_date):
+            breakup.add(post)
+        self._print_breakup(breakup)
+
+    def execute_dir(self, input_dir, manifest_file=None, pattern=POSTS_FILE_PATTERN, workers=None):
+        """ Report on the posts files below `input_dir`, with a `manifest_file` only on those changed since then"""
+        manifest = FileManifest(manifest_file) if manifest_file else None
+        for posts_file in get_posts_files(input_dir, pattern=pattern, manifest=manifest, workers=workers):
+            self.execute_streaming(posts_file)
+        if manifest:
+            manifest.save()
+
+    def execute_batch(self, profile_sources, state_dir, workers=None):
+        """
+        Report on many profiles, mapping profile id to its posts files as
+        `get_profile_sources` does, in a process pool. The counts of every
+        profile are kept in `state_dir`, so a rerun only reads the posts added
+        since the last one. Returns the number of posts read per profile.
+        """
+        profile_ids = list(profile_sources)
+        state_files = [join(state_dir, 'report_{}.json'.format(profile_id)) for profile_id in profile_ids]
+        new_posts_counts = dict()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(_update_profile_report, state_files,
+                                   [profile_sources[profile_id] for profile_id in profile_ids])
+            # Reports are printed in the order of profile_sources as the workers finish them.
+            for profile_id, (breakup_dict, new_posts) in zip(profile_ids, results):
+                breakup = PostBreakup.from_dict(breakup_dict)
+                if breakup.profile_id is None:
+                    breakup.profile_id = profile_id
+                self._print_breakup(breakup)
+                new_posts_counts[profile_id] = new_posts
+        return new_posts_counts
+
+    def execute_columnar(self, input_file):
+        """ Same report as `execute`, grouped over the columnar copy of `input_file` (built when missing or stale)"""
+        columns = self._get_columns(input_file)
+        self._print_breakup(PostBreakup.from_columns(columns))
+
+    def _get_columns(self, input_file):
+        columns_dir = '{}.columns'.format(input_file)
+        dictionary_file = join(columns_dir, PostColumns.DICTIONARY_FILE)
+        if PostColumns.exists(columns_dir) and getmtime(dictionary_file) >= getmtime(input_file):
+            return PostColumns(columns_dir)
+        return PostColumns.ingest(PostReader.iter_posts(input_file), columns_dir, domain_resolver.get_domains)
+
+    def _print_breakup(self, breakup):
+        print('ProfileID: {}'.format(breakup.profile_id))
+        self._print_sources(breakup.domain_counts.keys())
+        self._print_dict_counts(breakup.domain_counts, 'Source post count')
+        print('Type of Posts: {}'.format(', '.join(map(str, breakup.post_type_counts.keys()))))
+        self._print_dict_counts(breakup.post_type_counts, 'Post Type')
+        print('Total posts: {}, Posts with content: {}'.format(breakup.total_posts, breakup.posts_with_content))
+        print('Root Posts (Parent=None): {}'.format(breakup.root_posts))
+        print('Original Posts with PostType other than None: {}'.format(breakup.root_posts_with_post_type))
+        print('Comments: {}'.format(breakup.comments))
+        print('Posts with AuthorNames: {}'.format(breakup.posts_with_author_name))
+        print('Posts with avatar link (user image link): {}'.format(breakup.posts_with_avatar))
+        print('Original posts with post dynamics: {}'.format(breakup.original_posts_with_dynamics))
+        self._print_dict_counts(breakup.domain_dynamics_counts, 'Domain engagement dynamics')
+        self._line_break()
+
     def _get_breakup(self, posts):
         print('ProfileID: {}'.format(posts[0]['topics'][0]))
         self._get_sources(posts)
@@ -65,26 +496,27 @@ class FilterPosts:
         self._line_break()
 
     def dynamics_filter(self, post):
-        for dynamics in post['postDynamics']:
-            if dynamics['value'] != '0':
-                return True
-        return False
+        return has_dynamics(post)
 
     def _print_dict_lengths(self, post_type_dynamics, type_of_map=''):
+        counts = {key: len(value) for key, value in post_type_dynamics.items()}
+        self._print_dict_counts(counts, type_of_map)
+
+    def _print_dict_counts(self, counts, type_of_map=''):
         print('Printing the map for {}: '.format(type_of_map))
         index = ord('a')
-        list_keys = list(post_type_dynamics.keys())
-        list_keys.sort(key=lambda x: len(post_type_dynamics[x]), reverse=True)
-        # for key, value in post_type_dynamics.items():
-        #     print('\t{}. {}: {}'.format(chr(index), key, len(value)))
-        #     index += 1
+        list_keys = list(counts.keys())
+        list_keys.sort(key=lambda x: counts[x], reverse=True)
         for key in list_keys:
-            value = post_type_dynamics[key]
-            print('\t{}. {}: {}'.format(chr(index), key, len(value)))
+            print('\t{}. {}: {}'.format(chr(index), key, counts[key]))
             index += 1
 
     def _get_sources(self, posts):
-        unique_domains = set(map(lambda x: get_domain(x['externalLink']), posts))
+        unique_domains = set(domain_resolver.get_domains([post['externalLink'] for post in posts]))
+        self._print_sources(unique_domains)
+
+    def _print_sources(self, unique_domains):
+        unique_domains = set(unique_domains)
         social_media_domains = set(['twitter', 'facebook', 'youtube'])
         social_media_domain_list = ', '.join(social_media_domains.intersection(unique_domains))
         print('Social Media Sources: {}'.format(social_media_domain_list))
@@ -128,8 +560,9 @@ class FilterPosts:
 
     def _print_domain_dynamics(self, post_with_dynamics):
         post_type_dynamics = defaultdict(list)
-        for post in post_with_dynamics:
-            post_type_dynamics[get_domain(post['externalLink'])].append(post)
+        domains = domain_resolver.get_domains([post['externalLink'] for post in post_with_dynamics])
+        for post, domain in zip(post_with_dynamics, domains):
+            post_type_dynamics[domain].append(post)
         self._print_dict_lengths(post_type_dynamics, 'Domain engagement dynamics')
 
     def _print_post_type_for_original_posts(self, original_posts):
@@ -141,15 +574,23 @@ class FilterPosts:
 
     def _get_domain_breakup(self, posts):
         domain_count_map = defaultdict(list)
-        for post in posts:
-            domain_count_map[get_domain(post['externalLink'])].append(post)
+        domains = domain_resolver.get_domains([post['externalLink'] for post in posts])
+        for post, domain in zip(posts, domains):
+            domain_count_map[domain].append(post)
         self._print_dict_lengths(domain_count_map, 'Source post count')
 
 
 def main():
-    FilterPosts().execute('start_tv_posts/1056316/posts_1056316.json')
-    FilterPosts().execute('start_tv_posts/1441134/posts_1441134.json')
-    FilterPosts().execute('start_tv_posts/1446432/posts_1446432.json')
+    parser = argparse.ArgumentParser(description='Report on the posts of every profile extracted by get_posts.')
+    parser.add_argument('input_dir', nargs='?', default='start_tv_posts_2')
+    parser.add_argument('--profiles', nargs='+', help='Only report on these profile ids.')
+    parser.add_argument('--state-dir', default='filter_posts_state',
+                        help='Counts kept between runs, so reruns only read the posts added since.')
+    parser.add_argument('--workers', type=int, help='Processes reporting on profiles, one per CPU by default.')
+    args = parser.parse_args()
+    profile_sources = get_profile_sources(args.input_dir, profile_ids=args.profiles)
+    new_posts_counts = FilterPosts().execute_batch(profile_sources, args.state_dir, workers=args.workers)
+    print('Read {} new posts of {} profiles'.format(sum(new_posts_counts.values()), len(new_posts_counts)))
 
 
 if __name__ == '__main__':
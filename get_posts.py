@@ -1,12 +1,28 @@
-import sys
+import argparse
+import heapq
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from datetime import datetime, timedelta
+from itertools import islice
 
-from request_maker import RequestMaker
-from utils import JSONUtils, OSFileOperations
+from metrics import JSONLinesExporter, PAGE_SIZE_BUCKETS, PrometheusTextExporter, metrics
+from post_archive import PostArchive
+from post_store import Checkpoint, PostIndex, PostSink
+from request_maker import AsyncRequestMaker, RateLimiter, RequestMaker, SessionPool
+from user_agents import UserAgentProvider
+from utils import JSONCodec, JSONUtils, LazyModule, OSFileOperations
+
+# Only the --async extraction needs an event loop.
+asyncio = LazyModule('asyncio')
+
+API_BASE_URL = 'https://api.socialstudio.radian6.com'
 
 
 class EpochGenerator:
-    def get_new_epoch_time(self, date=datetime.now(), days=0):
+    def get_new_epoch_time(self, date=None, days=0):
+        date = date if date else datetime.now()
         delta = timedelta(days=days)
         new_date = date + delta
         epoch_time = new_date.timestamp()
@@ -16,14 +32,18 @@ class EpochGenerator:
 class StarTVClient:
     credentials_file = 'credentials.json'
 
-    def __init__(self):
+    def __init__(self, credentials_file=None):
+        if credentials_file:
+            self.credentials_file = credentials_file
         self.client_id = None
         self.client_secret = None
         self.username = None
         self.password = None
-        self._populate_credentials()
+        self.populated = False
 
     def get_client_info(self):
+        # Credentials are read when they are first needed, not when the client is created.
+        self._populate_credentials()
         client_info = {
             "client_id": self.client_id,
             "client_secret": self.client_secret
@@ -31,6 +51,7 @@ class StarTVClient:
         return client_info
 
     def get_user_account_info(self):
+        self._populate_credentials()
         user_account_info = {
             "username": self.username,
             "password": self.password
@@ -38,19 +59,26 @@ class StarTVClient:
         return user_account_info
 
     def _populate_credentials(self):
+        if self.populated:
+            return
         data = JSONUtils.load_json_data_from_file(self.credentials_file)
         self.client_id = data['client_id']
         self.client_secret = data['client_secret']
         self.username = data['username']
         self.password = data['password']
+        self.populated = True
 
 
 class AccessToken:
+    # Tokens are treated as expired this many seconds before the server says they do.
+    EXPIRY_MARGIN = 120
+
     def __init__(self):
         self.access_token = None
         self.refresh_token = None
         self.expires_in_seconds = None
-        self.generated_at_time = None
+        # time.monotonic() after which the token must not be used any more
+        self.expires_at = None
 
     def get(self):
         return self.access_token
@@ -61,47 +89,198 @@ class AccessToken:
         return self._validate_time_elapsed()
 
     def _validate_time_elapsed(self):
-        current_time = datetime.now()
-        return current_time.timestamp() - self.generated_at_time.timestamp() > self.expires_in_seconds
+        return time.monotonic() < self.expires_at
+
+    def get_seconds_left(self):
+        return self.expires_at - time.monotonic()
+
+    def expire(self):
+        self.expires_at = time.monotonic()
 
     def set(self, token_dict):
         self.access_token = token_dict['access_token']
         self.refresh_token = token_dict['refresh_token']
-        self.expires_in_seconds = token_dict['expires_in'] - 120
-        self.generated_at_time = datetime.now()
+        self.expires_in_seconds = token_dict['expires_in'] - self.EXPIRY_MARGIN
+        self.expires_at = time.monotonic() + self.expires_in_seconds
+
+    def to_dict(self):
+        # The monotonic clock does not survive the process, persisted tokens carry a wall-clock expiry.
+        return {'access_token': self.access_token,
+                'refresh_token': self.refresh_token,
+                'expires_at_epoch': time.time() + self.get_seconds_left()}
+
+    @staticmethod
+    def from_dict(token_dict):
+        access_token = AccessToken()
+        access_token.access_token = token_dict['access_token']
+        access_token.refresh_token = token_dict['refresh_token']
+        access_token.expires_in_seconds = token_dict['expires_at_epoch'] - time.time()
+        access_token.expires_at = time.monotonic() + access_token.expires_in_seconds
+        return access_token
 
 
 class TokenGenerator:
-    def __init__(self, client_info=StarTVClient()):
-        self.url = 'https://api.socialstudio.radian6.com/oauth/token'
-        self.client_info = client_info
+    """
+    Hands out a cached access token, refreshing it only once it expired or,
+    with `start_background_refresh`, shortly before it expires so callers never
+    wait for the token endpoint. Safe to share between threads. With a
+    `token_file` the token is persisted, so short-lived runs reuse it instead of
+    doing a fresh password grant.
+    """
+
+    # The background refresh starts at most this share of a token's lifetime before it expires.
+    REFRESH_AHEAD_SHARE = 0.5
+    # Seconds the background thread waits at least between refreshes, expired tokens are refreshed on demand.
+    MIN_REFRESH_INTERVAL = 10
+
+    def __init__(self, client_info=None, request_maker=None, token_file=None, refresh_ahead=300,
+                 base_url=API_BASE_URL):
+        # Extractors request posts from the API the token was issued by.
+        self.base_url = base_url
+        self.url = '{}/oauth/token'.format(base_url)
+        self.client_info = client_info if client_info else StarTVClient()
+        self.request_maker = request_maker if request_maker else RequestMaker()
+        self.token_file = token_file
+        # seconds before expiry at which the background thread refreshes the token, see _get_refresh_lead
+        self.refresh_ahead = refresh_ahead
         self.access_token = None
+        self.lock = threading.Lock()
+        self.refresh_thread = None
+        self.stop_refreshing = threading.Event()
+        # created on first use, inside the event loop of the async extractors
+        self.async_lock = None
 
     def _generate_token(self):
-        client_info = self.client_info.get_client_info()
-        user_info = self.client_info.get_user_account_info()
-        request_parameters = {**client_info, **user_info, "grant_type": "password"}
-        response = self._make_request(request_parameters)
+        response = self._make_request(self._get_password_grant())
         return self._gen_access_token(response)
 
     def _refresh_access_token(self):
+        try:
+            response = self._make_request(self._get_refresh_grant())
+        except ValueError as e:
+            print('Refreshing the access token failed ({}), requesting a new one'.format(e))
+            return self._generate_token()
+        return self._gen_access_token(response)
+
+    def _get_password_grant(self):
+        client_info = self.client_info.get_client_info()
+        user_info = self.client_info.get_user_account_info()
+        return {**client_info, **user_info, "grant_type": "password"}
+
+    def _get_refresh_grant(self):
         client_info = self.client_info.get_client_info()
         refresh_token = {'refresh_token': self.access_token.refresh_token}
-        request_parameters = {**client_info, **refresh_token, "grant_type": "refresh_token"}
-        response = self._make_request(request_parameters)
-        return self._gen_access_token(response)
+        return {**client_info, **refresh_token, "grant_type": "refresh_token"}
 
     def _make_request(self, request_parameters):
-        request_maker = RequestMaker()
-        response = request_maker.post_request(url=self.url, json=request_parameters)
-        return response.json()
+        metrics.inc('token_grants_total', grant_type=request_parameters['grant_type'])
+        with metrics.timer('token_grant_seconds'):
+            response = self.request_maker.post_request(url=self.url, json=request_parameters)
+        return JSONCodec.loads(response.content)
 
     def get_token(self):
-        if not self.access_token:
-            self.access_token = self._generate_token()
-        elif not self.access_token.is_token_valid():
-            self.access_token = self._refresh_access_token()
-        return self.access_token.get()
+        # Extractors running in parallel share one generator; only one of them may (re)issue the grant.
+        with self.lock:
+            if not self.access_token:
+                self.access_token = self._load_token()
+            if not self.access_token:
+                self._set_token(self._generate_token())
+            elif not self.access_token.is_token_valid():
+                self._set_token(self._refresh_access_token())
+            return self.access_token.get()
+
+    def get_header(self):
+        return {'Authorization': 'Bearer {}'.format(self.get_token())}
+
+    async def get_header_async(self, request_maker):
+        return {'Authorization': 'Bearer {}'.format(await self.get_token_async(request_maker))}
+
+    def invalidate(self, authorization=None):
+        """ Expire the token the API rejected in `authorization`, unless another caller already replaced it"""
+        with self.lock:
+            if not self.access_token:
+                return
+            if authorization is None or authorization == 'Bearer {}'.format(self.access_token.get()):
+                # The next get_token tries a refresh grant, falling back to the password grant.
+                self.access_token.expire()
+
+    async def get_token_async(self, request_maker):
+        """ get_token for coroutines, requesting new tokens through the AsyncRequestMaker `request_maker`"""
+        if self.async_lock is None:
+            self.async_lock = asyncio.Lock()
+        async with self.async_lock:
+            with self.lock:
+                if not self.access_token:
+                    self.access_token = self._load_token()
+                if self.access_token and self.access_token.is_token_valid():
+                    return self.access_token.get()
+                grant = self._get_refresh_grant() if self.access_token else self._get_password_grant()
+            metrics.inc('token_grants_total', grant_type=grant['grant_type'])
+            try:
+                response = await request_maker.post_request(url=self.url, json=grant)
+            except ValueError as e:
+                if grant['grant_type'] == 'password':
+                    raise
+                print('Refreshing the access token failed ({}), requesting a new one'.format(e))
+                metrics.inc('token_grants_total', grant_type='password')
+                response = await request_maker.post_request(url=self.url, json=self._get_password_grant())
+            with self.lock:
+                self._set_token(self._gen_access_token(JSONCodec.loads(response.content)))
+                return self.access_token.get()
+
+    def start_background_refresh(self):
+        if self.refresh_thread:
+            return
+        self.stop_refreshing.clear()
+        self.refresh_thread = threading.Thread(target=self._refresh_in_background, name='token-refresh', daemon=True)
+        self.refresh_thread.start()
+
+    def stop_background_refresh(self):
+        self.stop_refreshing.set()
+        if self.refresh_thread:
+            self.refresh_thread.join()
+            self.refresh_thread = None
+
+    def _refresh_in_background(self):
+        while not self.stop_refreshing.is_set():
+            try:
+                self.get_token()
+                with self.lock:
+                    sleep_secs = self.access_token.get_seconds_left() - self._get_refresh_lead()
+                if self.stop_refreshing.wait(max(sleep_secs, self.MIN_REFRESH_INTERVAL)):
+                    return
+                # Callers keep using the current token while the new one is requested.
+                access_token = self._refresh_access_token()
+                with self.lock:
+                    self._set_token(access_token)
+            except ValueError as e:
+                print('Background token refresh failed: {}'.format(e))
+                # get_token still refreshes on demand once the token expired.
+                self.stop_refreshing.wait(60)
+
+    def _get_refresh_lead(self):
+        """ `refresh_ahead`, capped by the token's lifetime so short-lived tokens are not renewed nonstop"""
+        lifetime = max(self.access_token.expires_in_seconds, 0)
+        return min(self.refresh_ahead, lifetime * self.REFRESH_AHEAD_SHARE)
+
+    def _set_token(self, access_token):
+        self.access_token = access_token
+        if self.token_file:
+            token_dict = {**access_token.to_dict(), 'username': self.client_info.get_user_account_info()['username']}
+            # Owner only from the moment the file is created, it holds a bearer and a refresh token.
+            JSONUtils.write_json_data_to_file(self.token_file, token_dict, file_mode=0o600)
+
+    def _load_token(self):
+        if not self.token_file or not OSFileOperations.entity_exists(self.token_file):
+            return None
+        token_dict = JSONUtils.load_json_data_from_file(self.token_file)
+        if token_dict.get('username') != self.client_info.get_user_account_info()['username']:
+            return None
+        access_token = AccessToken.from_dict(token_dict)
+        if not access_token.is_token_valid():
+            # Still worth a refresh grant, which is cheaper than the password grant.
+            print('Persisted access token expired, refreshing it')
+        return access_token
 
     def _gen_access_token(self, response):
         access_token = AccessToken()
@@ -109,87 +288,323 @@ class TokenGenerator:
         return access_token
 
 
+class ExtractionContext:
+    """
+    The objects an extraction run shares, each created on first use: reading
+    the credentials waits for the first token request and importing the HTTP
+    stack for the first API call, so commands that never reach the API (like
+    --export-only) start without either.
+    """
+
+    def __init__(self, base_url=API_BASE_URL, credentials_file=None, token_file=None, rate_limiter=None,
+                 pool_size=SessionPool.DEFAULT_POOL_SIZE):
+        self.base_url = base_url
+        self.credentials_file = credentials_file
+        self.token_file = token_file
+        self.rate_limiter = rate_limiter
+        self.pool_size = pool_size
+        self._client_info = None
+        self._request_maker = None
+        self._token_generator = None
+        self.lock = threading.Lock()
+
+    @property
+    def client_info(self):
+        with self.lock:
+            if self._client_info is None:
+                self._client_info = StarTVClient(credentials_file=self.credentials_file)
+            return self._client_info
+
+    @property
+    def request_maker(self):
+        with self.lock:
+            if self._request_maker is None:
+                self._request_maker = RequestMaker(rate_limiter=self.rate_limiter, pool_size=self.pool_size)
+            return self._request_maker
+
+    @property
+    def token_generator(self):
+        client_info, request_maker = self.client_info, self.request_maker
+        with self.lock:
+            if self._token_generator is None:
+                self._token_generator = TokenGenerator(client_info=client_info, request_maker=request_maker,
+                                                       token_file=self.token_file, base_url=self.base_url)
+            return self._token_generator
+
+
 class FileComponents:
-    def __init__(self, profile_id):
+    def __init__(self, profile_id, shard=None):
         self.profile_id = profile_id
+        # Time shards of a sharded backfill keep their files below the profile directory.
+        self.shard = shard
+        self.base_dir = None
         self.file_with_content = None
         self.file_without_content = None
         self.file_with_all_posts = None
         self.state_file = None
+        self.journal_file = None
+        self.index_file = None
+        self.tail_file = None
+        self.archive_dir = None
+        self.sink_with_content = None
+        self.sink_without_content = None
         self._gen_names()
 
     def _gen_names(self):
-        self.file_with_content = 'start_tv_posts_2/{profile_id}/with_content/posts_with_{profile_id}.json'.format(
-            profile_id=self.profile_id)
-        self.file_without_content = 'start_tv_posts_2/{profile_id}/without_content/posts_without_{profile_id}.json'.format(
-            profile_id=self.profile_id)
-        self.file_with_all_posts = 'start_tv_posts_2/{profile_id}/posts_{profile_id}.json'.format(
-            profile_id=self.profile_id)
-        self.state_file = 'start_tv_posts_2/{profile_id}/state_{profile_id}.json'.format(
-            profile_id=self.profile_id)
+        self.base_dir = 'start_tv_posts_2/{profile_id}'.format(profile_id=self.profile_id)
+        if self.shard:
+            self.base_dir = '{base_dir}/shards/{shard}'.format(base_dir=self.base_dir, shard=self.shard)
+        self.file_with_content = '{base_dir}/with_content/posts_with_{profile_id}.json'.format(
+            base_dir=self.base_dir, profile_id=self.profile_id)
+        self.file_without_content = '{base_dir}/without_content/posts_without_{profile_id}.json'.format(
+            base_dir=self.base_dir, profile_id=self.profile_id)
+        self.file_with_all_posts = '{base_dir}/posts_{profile_id}.json'.format(
+            base_dir=self.base_dir, profile_id=self.profile_id)
+        self.state_file = '{base_dir}/state_{profile_id}.json'.format(
+            base_dir=self.base_dir, profile_id=self.profile_id)
+        self.journal_file = '{base_dir}/journal_{profile_id}.ndjson'.format(
+            base_dir=self.base_dir, profile_id=self.profile_id)
+        self.index_file = '{base_dir}/seen_{profile_id}.sqlite'.format(
+            base_dir=self.base_dir, profile_id=self.profile_id)
+        self.tail_file = '{base_dir}/tail_{profile_id}.json'.format(
+            base_dir=self.base_dir, profile_id=self.profile_id)
+        self.archive_dir = '{base_dir}/posts_{profile_id}.archive'.format(
+            base_dir=self.base_dir, profile_id=self.profile_id)
+        self.sink_with_content = '{base_dir}/with_content/posts_with_{profile_id}.ndjson'.format(
+            base_dir=self.base_dir, profile_id=self.profile_id)
+        self.sink_without_content = '{base_dir}/without_content/posts_without_{profile_id}.ndjson'.format(
+            base_dir=self.base_dir, profile_id=self.profile_id)
 
 
 class PostExtractor:
-    def __init__(self, token_generator):
+    def __init__(self, token_generator, request_maker=None, fsync_every=1, prefetch_pages=2):
         self.token_generator = token_generator
-        self.url = 'https://api.socialstudio.radian6.com/v3/posts'
+        # Created on first use: exports and the async extraction never send through it.
+        self._request_maker = request_maker
+        base_url = token_generator.base_url if token_generator else API_BASE_URL
+        self.url = '{}/v3/posts'.format(base_url)
+        self.fsync_every = fsync_every
+        # pages fetched ahead of the one being stored, 0 fetches and stores strictly in turn
+        self.prefetch_pages = prefetch_pages
         self.file_components = None
+        self.posts_with_content = None
+        self.posts_without_content = None
+        self.checkpoint = None
+        self.post_index = None
+        # posts stored since the sinks were opened
+        self.total_count_with_content = 0
+        self.total_count_without_count = 0
+
+    @property
+    def request_maker(self):
+        if self._request_maker is None:
+            self._request_maker = RequestMaker()
+        return self._request_maker
 
     def write_api_data(self, profile_id):
-        self.file_components = FileComponents(profile_id)
-        data = self.get_posts(profile_id)
-        self._write_data_to_json(self.file_components.file_with_all_posts, data)
+        self._open_sinks(profile_id)
+        self.get_posts(profile_id)
+        self._export_sinks()
+
+    def export_api_data(self, profile_id):
+        self._open_sinks(profile_id)
+        self._export_sinks()
+
+    def archive_api_data(self, profile_id, chunk_days=1, compression='gzip'):
+        """ Write the stored posts into a compressed archive, in publishedDate order and chunked by `chunk_days`"""
+        self._open_sinks(profile_id)
+        # Both sinks are sorted by publishedDate, as the pages were requested.
+        posts = heapq.merge(self.posts_with_content.iter_posts(), self.posts_without_content.iter_posts(),
+                            key=lambda post: post.get('publishedDate') or 0)
+        archive = PostArchive.write(posts, self.file_components.archive_dir, chunk_days=chunk_days,
+                                    compression=compression)
+        print('{}: archived {} posts in {} chunks'.format(profile_id, archive.count, len(archive.chunks)))
+
+    def sync(self, profile_id):
+        """ Fetch what was published since the last committed page, returning how many new posts were stored"""
+        self._open_sinks(profile_id)
+        stored_count = self.posts_with_content.count + self.posts_without_content.count
+        self.get_posts(profile_id)
+        return self.posts_with_content.count + self.posts_without_content.count - stored_count
+
+    def write_shard(self, profile_id, start_date, end_date):
+        """ Extract the posts published in [start_date, end_date) into the shard's own files, returning its cursor"""
+        self._open_sinks(profile_id, shard='{}_{}'.format(start_date, end_date))
+        return self.get_posts(profile_id, start_date=start_date, end_date=end_date)
+
+    def get_posts(self, profile_id, start_date=None, end_date=None):
+        params = self._load_parameters(profile_id, start_date=start_date, end_date=end_date)
+        if self.prefetch_pages:
+            return self._get_posts_pipelined(profile_id, params)
+        pagination = True
+        while pagination:
+            resp_data = self._fetch_page(params)
+            params, pagination = self._get_next_params(params, resp_data)
+            self._store_page(profile_id, params, resp_data)
+        return params
 
-    def get_posts(self, profile_id):
-        params = self._load_parameters(profile_id)
-        request_maker = RequestMaker()
+    def _get_posts_pipelined(self, profile_id, params):
+        """
+        A fetcher thread requests the next page as soon as its cursor is known and
+        hands pages over through a queue of `prefetch_pages`, while this thread
+        segregates and persists them. A full queue holds the fetcher back.
+        """
+        pages = queue.Queue(maxsize=self.prefetch_pages)
+        stop_fetching = threading.Event()
+        fetcher = threading.Thread(target=self._fetch_pages, args=(params, pages, stop_fetching),
+                                   name='fetcher-{}'.format(profile_id), daemon=True)
+        fetcher.start()
+        try:
+            while True:
+                # Time spent here is time the writer had nothing to store, i.e. the fetcher is the bottleneck.
+                with metrics.timer('page_queue_wait_seconds'):
+                    page = pages.get()
+                if isinstance(page, BaseException):
+                    raise page
+                resp_data, params, pagination = page
+                self._store_page(profile_id, params, resp_data)
+                if not pagination:
+                    return params
+        finally:
+            # Pages fetched ahead and not stored yet are fetched again on resume.
+            stop_fetching.set()
+
+    def _fetch_pages(self, params, pages, stop_fetching):
+        pagination = True
+        try:
+            while pagination and not stop_fetching.is_set():
+                resp_data = self._fetch_page(params)
+                params, pagination = self._get_next_params(params, resp_data)
+                self._put_page(pages, (resp_data, params, pagination), stop_fetching)
+        except BaseException as e:
+            # Re-raised by the storing thread, which would otherwise wait for pages forever.
+            self._put_page(pages, e, stop_fetching)
+
+    def _put_page(self, pages, page, stop_fetching):
+        while not stop_fetching.is_set():
+            try:
+                pages.put(page, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def _fetch_page(self, params):
+        print('Making API call at {}: {}'.format(datetime.now(), params))
+        with metrics.timer('page_request_seconds'):
+            response = self.request_maker.get_request(self.url, params=params, auth=self.token_generator)
+        return self._parse_page(response)
+
+    def _parse_page(self, response):
+        with metrics.timer('page_parse_seconds'):
+            resp_data = JSONCodec.loads(response.content)
+        metrics.observe('page_posts', len(resp_data['data']), buckets=PAGE_SIZE_BUCKETS)
+        return resp_data
+
+    async def write_api_data_async(self, profile_id, request_maker):
+        """ write_api_data on an AsyncRequestMaker, file work runs in the default executor"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._open_sinks, profile_id)
+        await self.get_posts_async(profile_id, request_maker)
+        await loop.run_in_executor(None, self._export_sinks)
+
+    async def get_posts_async(self, profile_id, request_maker):
+        loop = asyncio.get_running_loop()
+        params = await loop.run_in_executor(None, self._load_parameters, profile_id)
         pagination = True
-        total_count_with_content, total_count_without_count = 0, 0
-        total_data = {'data': [],
-                      'meta': {
-                          'totalCount': 0
-                      }}
         while pagination:
             print('Making API call at {}: {}'.format(datetime.now(), params))
-            header = self._get_header()
-            response = request_maker.get_request(self.url, params=params, header=header)
-            resp_data = response.json()
-            posts_with_content, posts_without_content = self._segregate_posts(resp_data['data'])
-            total_count_with_content += len(posts_with_content)
-            total_count_without_count += len(posts_without_content)
-            self._write_data_to_json(self.file_components.file_with_content, posts_with_content)
-            self._write_data_to_json(self.file_components.file_without_content, posts_without_content)
-            remaining_count = resp_data['meta']['totalCount']
-            if remaining_count <= 1:
-                pagination = False
-            else:
-                last_id = resp_data['data'][-1]['id']
-                # next_params = {'beforeId': last_id}
-                next_params = {'sinceId': last_id}
-                params = {**params, **next_params}
-            self._write_state(params)
-            print('With content: {}, without content: {} at {}'.format(total_count_with_content,
-                                                                       total_count_without_count,
-                                                                       datetime.now()))
-        return total_data
+            with metrics.timer('page_request_seconds'):
+                response = await request_maker.get_request(self.url, params=params, auth=self.token_generator)
+            resp_data = self._parse_page(response)
+            params, pagination = self._get_next_params(params, resp_data)
+            # Stores and fsyncs the page off the event loop, other profiles keep downloading meanwhile.
+            await loop.run_in_executor(None, self._store_page, profile_id, params, resp_data)
+        return params
 
-    def _get_header(self):
-        access_token = self.token_generator.get_token()
-        bearer_token = 'Bearer {}'.format(access_token)
-        header = {'Authorization': bearer_token}
-        return header
+    def _get_next_params(self, params, resp_data):
+        """ Parameters of the page after `resp_data` and whether there is one"""
+        remaining_count = resp_data['meta']['totalCount']
+        pagination = True
+        if resp_data['data']:
+            # The cursor also moves past the last page, so the next run only asks for newer posts.
+            last_id = resp_data['data'][-1]['id']
+            # next_params = {'beforeId': last_id}
+            next_params = {'sinceId': last_id}
+            params = {**params, **next_params}
+        if remaining_count <= 1 or not resp_data['data']:
+            pagination = False
+        return params, pagination
+
+    def _store_page(self, profile_id, params, resp_data):
+        """ Persist one page and commit `params`, the parameters of the page after it"""
+        with metrics.timer('page_dedupe_seconds'):
+            new_posts = self.post_index.filter_new(resp_data['data'])
+        posts_with_content, posts_without_content = self._segregate_posts(new_posts)
+        self.total_count_with_content += len(posts_with_content)
+        self.total_count_without_count += len(posts_without_content)
+        with metrics.timer('page_append_seconds'):
+            self.posts_with_content.append(posts_with_content)
+            self.posts_without_content.append(posts_without_content)
+        with metrics.timer('checkpoint_commit_seconds'):
+            self._write_state(params, [post['id'] for post in resp_data['data']], [post['id'] for post in new_posts])
+        metrics.inc('pages_total')
+        metrics.inc('posts_stored_total', len(posts_with_content), content='yes')
+        metrics.inc('posts_stored_total', len(posts_without_content), content='no')
+        metrics.inc('posts_duplicate_total', len(resp_data['data']) - len(new_posts))
+        print('{}: With content: {}, without content: {} at {}'.format(profile_id,
+                                                                       self.total_count_with_content,
+                                                                       self.total_count_without_count,
+                                                                       datetime.now()))
 
-    def _write_data_to_json(self, file_name, posts):
-        if OSFileOperations.entity_exists(file_name):
-            total_data = JSONUtils.load_json_data_from_file(file_name)
-        else:
-            total_data = {'data': [],
-                          'meta': {
-                              'totalCount': 0
-                          }}
-        total_data['data'] += posts
-        total_data['meta']['totalCount'] += len(posts)
-        JSONUtils.write_json_data_to_file(file_name, total_data)
+    def merge_shards(self, profile_id, shards, params, batch_size=1000):
+        """ Append the posts of finished time shards, oldest shard first, to the profile's own files"""
+        self._open_sinks(profile_id)
+        # Rolls back the appends of a merge that was interrupted, the index skips what was committed.
+        self._load_parameters(profile_id)
+        for shard in shards:
+            shard_components = FileComponents(profile_id, shard=shard)
+            for sink, shard_sink_file in ((self.posts_with_content, shard_components.sink_with_content),
+                                          (self.posts_without_content, shard_components.sink_without_content)):
+                posts = PostSink(shard_sink_file).iter_posts()
+                batch = list(islice(posts, batch_size))
+                while batch:
+                    new_posts = self.post_index.filter_new(batch)
+                    sink.append(new_posts)
+                    self._write_state(params, [post['id'] for post in batch], [post['id'] for post in new_posts])
+                    batch = list(islice(posts, batch_size))
+        self._export_sinks()
+
+    def _open_sinks(self, profile_id, shard=None):
+        self.file_components = FileComponents(profile_id, shard=shard)
+        self.total_count_with_content, self.total_count_without_count = 0, 0
+        self.posts_with_content = PostSink(self.file_components.sink_with_content)
+        self.posts_without_content = PostSink(self.file_components.sink_without_content)
+        # Profiles extracted before the NDJSON sinks existed only have the legacy dumps.
+        self.posts_with_content.import_legacy(self.file_components.file_with_content)
+        self.posts_without_content.import_legacy(self.file_components.file_without_content)
+        sinks = {'with_content': self.posts_with_content,
+                 'without_content': self.posts_without_content}
+        self.checkpoint = Checkpoint(self.file_components.state_file, self.file_components.journal_file, sinks,
+                                     fsync_every=self.fsync_every)
+        self.post_index = self._open_post_index()
+
+    def _open_post_index(self):
+        index_exists = OSFileOperations.entity_exists(self.file_components.index_file)
+        post_index = PostIndex(self.file_components.index_file)
+        if not index_exists:
+            self._seed_post_index(post_index)
+        return post_index
+
+    def _seed_post_index(self, post_index):
+        for sink in (self.posts_with_content, self.posts_without_content):
+            post_index.seed(sink.iter_posts())
+
+    def _export_sinks(self):
+        with metrics.timer('export_seconds'):
+            self.posts_with_content.export(self.file_components.file_with_content)
+            self.posts_without_content.export(self.file_components.file_without_content)
+            PostSink.export_many([self.posts_with_content, self.posts_without_content],
+                                 self.file_components.file_with_all_posts)
 
     def _segregate_posts(self, posts):
         with_content, without_content = [], []
@@ -200,25 +615,392 @@ class PostExtractor:
                 without_content.append(post)
         return with_content, without_content
 
-    def _load_parameters(self, profile_id):
-        if OSFileOperations.entity_exists(self.file_components.state_file):
-            params = JSONUtils.load_json_data_from_file(self.file_components.state_file)
+    def _load_parameters(self, profile_id, start_date=None, end_date=None):
+        params = self.checkpoint.load()
+        if self.checkpoint.rolled_back:
+            # The sinks lost posts the index already holds, which would otherwise be skipped when fetched again.
+            self.post_index.clear()
+            self._seed_post_index(self.post_index)
         else:
-            epoch_time = EpochGenerator().get_new_epoch_time(days=-91)
+            # The index is only updated after a page was committed, catch up in case the job died in between.
+            self.post_index.add(self.checkpoint.stored_ids)
+        if params is None:
+            epoch_time = start_date if start_date else EpochGenerator().get_new_epoch_time(days=-91)
             params = {'topics': profile_id, 'limit': 1000, 'startDate': epoch_time,
                       'sortBy': 'publishedDate-ascending'
                       }
+            if end_date:
+                params['endDate'] = end_date
+        return params
+
+    def _write_state(self, params, page_ids, stored_ids):
+        self.checkpoint.commit(params, page_ids, stored_ids)
+        self.post_index.add(stored_ids)
+
+
+class MultiProfileExtractor:
+    """
+    Extracts several topic profiles concurrently. All workers share one token
+    generator and one request maker, so a single OAuth grant and a single
+    request budget against the API host are used for the whole batch.
+    """
+
+    def __init__(self, token_generator, request_maker, workers=4):
+        self.token_generator = token_generator
+        self.request_maker = request_maker
+        self.workers = workers
+
+    def write_api_data(self, profile_ids):
+        failed_profiles = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self._write_profile, profile_id): profile_id for profile_id in profile_ids}
+            for future in as_completed(futures):
+                profile_id = futures[future]
+                try:
+                    future.result()
+                    print('Finished profile {} at {}'.format(profile_id, datetime.now()))
+                except Exception as e:
+                    print('Failed profile {}: {}'.format(profile_id, e))
+                    failed_profiles.append(profile_id)
+        return failed_profiles
+
+    def _write_profile(self, profile_id):
+        # PostExtractor keeps per-profile file state, so every profile gets its own instance.
+        post_extractor = PostExtractor(self.token_generator, request_maker=self.request_maker)
+        post_extractor.write_api_data(profile_id)
+
+
+class ShardedBackfill:
+    """
+    Backfills one profile by splitting its time range into shards that are
+    extracted concurrently, each with its own cursor and checkpoint, and then
+    merged into the profile's files oldest shard first. Pages are sorted by
+    publishedDate within a shard and shards do not overlap, so the merged files
+    keep the publishedDate order of a sequential run.
+    """
+    DAY_MILLIS = 24 * 60 * 60 * 1000
+    # Adaptive planning does not split shards below an hour.
+    MIN_SHARD_MILLIS = 60 * 60 * 1000
+
+    def __init__(self, token_generator, request_maker, workers=4, shard_days=1, max_posts_per_shard=None):
+        self.token_generator = token_generator
+        self.request_maker = request_maker
+        self.workers = workers
+        self.shard_days = shard_days
+        # When set, shards with more posts than this are split in halves before extraction.
+        self.max_posts_per_shard = max_posts_per_shard
+        self.url = '{}/v3/posts'.format(token_generator.base_url)
+
+    def write_api_data(self, profile_id, days=91):
+        shards_dir = '{}/shards'.format(FileComponents(profile_id).base_dir)
+        shards = self._load_plan(profile_id, shards_dir, days)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            # Re-raises the first failure; finished shards resume from their checkpoints on the next run.
+            cursors = list(executor.map(lambda shard: self._write_shard(profile_id, shard), shards))
+        params = self._get_final_params(shards, cursors)
+        post_extractor = PostExtractor(self.token_generator, request_maker=self.request_maker)
+        post_extractor.merge_shards(profile_id, ['{}_{}'.format(*shard) for shard in shards], params)
+        OSFileOperations.remove_entity(shards_dir)
+
+    def _write_shard(self, profile_id, shard):
+        post_extractor = PostExtractor(self.token_generator, request_maker=self.request_maker)
+        return post_extractor.write_shard(profile_id, *shard)
+
+    def _get_final_params(self, shards, cursors):
+        # The profile continues sequentially after the newest post any shard has seen.
+        params = {**cursors[-1], 'startDate': shards[0][0]}
+        params.pop('endDate', None)
+        params.pop('sinceId', None)
+        for cursor in reversed(cursors):
+            if 'sinceId' in cursor:
+                params['sinceId'] = cursor['sinceId']
+                break
         return params
 
-    def _write_state(self, params):
-        JSONUtils.write_json_data_to_file(self.file_components.state_file, params)
+    def _load_plan(self, profile_id, shards_dir, days):
+        # The plan is kept so that a rerun after a crash finds the same shards and their checkpoints.
+        plan_file = '{}/plan.json'.format(shards_dir)
+        if OSFileOperations.entity_exists(plan_file):
+            return [tuple(shard) for shard in JSONUtils.load_json_data_from_file(plan_file)]
+        epoch_generator = EpochGenerator()
+        end_date = epoch_generator.get_new_epoch_time(date=datetime.now())
+        start_date = epoch_generator.get_new_epoch_time(date=datetime.now(), days=-days)
+        shards = self._plan_shards(profile_id, start_date, end_date)
+        JSONUtils.write_json_data_to_file(plan_file, shards)
+        return shards
+
+    def _plan_shards(self, profile_id, start_date, end_date):
+        step = int(self.shard_days * self.DAY_MILLIS)
+        shards = [(start, min(start + step, end_date)) for start in range(start_date, end_date, step)]
+        if not self.max_posts_per_shard:
+            return shards
+        planned_shards = []
+        while shards:
+            start, end = shards.pop(0)
+            if end - start > self.MIN_SHARD_MILLIS and self._count_posts(profile_id, start, end) > self.max_posts_per_shard:
+                middle = (start + end) // 2
+                shards[0:0] = [(start, middle), (middle, end)]
+            else:
+                planned_shards.append((start, end))
+        return planned_shards
+
+    def _count_posts(self, profile_id, start_date, end_date):
+        params = {'topics': profile_id, 'limit': 1, 'startDate': start_date, 'endDate': end_date}
+        response = self.request_maker.get_request(self.url, params=params, auth=self.token_generator)
+        return JSONCodec.loads(response.content)['meta']['totalCount']
+
+
+class IncrementalSync:
+    """
+    Keeps a profile up to date by polling from its checkpoint, the high-water
+    mark of the last post stored, so each poll only downloads new posts and
+    never exports the legacy files. The poll interval follows the recent post
+    velocity, aiming at `target_posts_per_poll` new posts per poll within
+    [min_interval, max_interval] seconds. The schedule is persisted per
+    profile, so `once=True` can be run from cron as often as desired.
+    """
+    # weight of the latest poll in the post velocity estimate
+    VELOCITY_SMOOTHING = 0.3
+
+    def __init__(self, token_generator, request_maker, min_interval=60, max_interval=3600, target_posts_per_poll=500):
+        self.token_generator = token_generator
+        self.request_maker = request_maker
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_posts_per_poll = target_posts_per_poll
+
+    def run(self, profile_ids, workers=4, once=False):
+        """
+        Poll `profile_ids` whenever they are due, at most `workers` at a time.
+        A single scheduler picks the profile with the earliest nextPollAt, so
+        every profile is polled however many there are per worker. A failed
+        poll is logged and retried after a backoff growing from min_interval
+        to max_interval, without stopping the other profiles. With `once`,
+        each profile due now is polled once, profiles not due yet are skipped
+        and the profiles whose poll failed are returned.
+        """
+        failed_profiles = []
+        # profile id -> polls failed in a row
+        failures = dict()
+        schedule = []
+        for profile_id in profile_ids:
+            next_poll_at = self._load_tail_state(FileComponents(profile_id).tail_file)['nextPollAt']
+            if once and next_poll_at > time.time():
+                print('{}: next poll due in {:.0f}s'.format(profile_id, next_poll_at - time.time()))
+                continue
+            heapq.heappush(schedule, (next_poll_at, profile_id))
+        # Each profile is polled by one thread at a time, so its extractor is reused across polls.
+        post_extractors = dict()
+        # future -> profile id
+        polls = dict()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while schedule or polls:
+                while schedule and len(polls) < workers and schedule[0][0] <= time.time():
+                    _, profile_id = heapq.heappop(schedule)
+                    if profile_id not in post_extractors:
+                        post_extractors[profile_id] = PostExtractor(self.token_generator,
+                                                                    request_maker=self.request_maker)
+                    polls[executor.submit(self.poll, profile_id, post_extractors[profile_id])] = profile_id
+                timeout = None
+                if schedule and len(polls) < workers:
+                    timeout = max(schedule[0][0] - time.time(), 0)
+                if not polls:
+                    time.sleep(timeout)
+                    continue
+                done, _ = wait(polls, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    profile_id = polls.pop(future)
+                    try:
+                        tail_state = future.result()
+                    except Exception as e:
+                        print('Failed profile {}: {}'.format(profile_id, e))
+                        # The next poll resumes from the checkpoint with a fresh extractor.
+                        post_extractors.pop(profile_id, None)
+                        if once:
+                            failed_profiles.append(profile_id)
+                            continue
+                        failures[profile_id] = failures.get(profile_id, 0) + 1
+                        retry_in = min(self.min_interval * 2 ** (failures[profile_id] - 1), self.max_interval)
+                        heapq.heappush(schedule, (time.time() + retry_in, profile_id))
+                        continue
+                    failures.pop(profile_id, None)
+                    if not once:
+                        heapq.heappush(schedule, (tail_state['nextPollAt'], profile_id))
+        return failed_profiles
+
+    def poll(self, profile_id, post_extractor=None):
+        """ Fetch the new posts of `profile_id` and schedule its next poll, returning its tail state"""
+        file_components = FileComponents(profile_id)
+        if post_extractor is None:
+            post_extractor = PostExtractor(self.token_generator, request_maker=self.request_maker)
+        tail_state = self._load_tail_state(file_components.tail_file)
+        poll_started_at = time.time()
+        new_posts_count = post_extractor.sync(profile_id)
+        tail_state = self._schedule_next_poll(tail_state, new_posts_count, poll_started_at)
+        JSONUtils.write_json_data_to_file(file_components.tail_file, tail_state)
+        print('{}: {} new posts, {:.3f} posts/s, next poll in {:.0f}s'.format(
+            profile_id, new_posts_count, tail_state['velocity'], tail_state['nextPollAt'] - time.time()))
+        return tail_state
+
+    def _schedule_next_poll(self, tail_state, new_posts_count, poll_started_at):
+        velocity = tail_state['velocity']
+        if tail_state['lastPollAt']:
+            elapsed = max(poll_started_at - tail_state['lastPollAt'], 1)
+            poll_velocity = new_posts_count / elapsed
+            velocity = self.VELOCITY_SMOOTHING * poll_velocity + (1 - self.VELOCITY_SMOOTHING) * velocity
+        interval = self.target_posts_per_poll / velocity if velocity else self.max_interval
+        interval = min(max(interval, self.min_interval), self.max_interval)
+        return {'lastPollAt': poll_started_at,
+                'velocity': velocity,
+                'nextPollAt': poll_started_at + interval}
+
+    def _load_tail_state(self, tail_file):
+        if OSFileOperations.entity_exists(tail_file):
+            return JSONUtils.load_json_data_from_file(tail_file)
+        return {'lastPollAt': None, 'velocity': 0, 'nextPollAt': 0}
+
+
+class AsyncMultiProfileExtractor:
+    """
+    MultiProfileExtractor on one event loop: up to `concurrency` profiles are
+    paginated at once through a single AsyncRequestMaker, without a thread per
+    profile.
+    """
+
+    def __init__(self, token_generator, rate_limiter=None, concurrency=50):
+        self.token_generator = token_generator
+        self.rate_limiter = rate_limiter
+        self.concurrency = concurrency
+
+    def write_api_data(self, profile_ids):
+        return asyncio.run(self._write_api_data(profile_ids))
+
+    async def _write_api_data(self, profile_ids):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        async with AsyncRequestMaker(rate_limiter=self.rate_limiter, pool_size=self.concurrency) as request_maker:
+            async def write_profile(profile_id):
+                async with semaphore:
+                    post_extractor = PostExtractor(self.token_generator)
+                    await post_extractor.write_api_data_async(profile_id, request_maker)
+            results = await asyncio.gather(*(write_profile(profile_id) for profile_id in profile_ids),
+                                           return_exceptions=True)
+        print('Requests: {}'.format(request_maker.stats.to_dict()))
+        failed_profiles = []
+        for profile_id, result in zip(profile_ids, results):
+            if isinstance(result, Exception):
+                print('Failed profile {}: {}'.format(profile_id, result))
+                failed_profiles.append(profile_id)
+            else:
+                print('Finished profile {} at {}'.format(profile_id, datetime.now()))
+        return failed_profiles
+
+
+def load_profile_ids(profiles_file):
+    profile_ids = []
+    with open(profiles_file) as file:
+        for line in file:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                profile_ids.append(line)
+    return profile_ids
 
 
 def main():
-    profile_id = sys.argv[1]
-    token_generator = TokenGenerator()
-    post_extractor = PostExtractor(token_generator)
-    post_extractor.write_api_data(profile_id)
+    parser = argparse.ArgumentParser(description='Extract SocialStudio posts of one or more topic profiles.')
+    parser.add_argument('profile_ids', nargs='*')
+    parser.add_argument('--profiles-file', help='File with one profile id per line.')
+    parser.add_argument('--workers', type=int, default=4, help='Profiles extracted concurrently.')
+    parser.add_argument('--rate', type=float, default=0.1,
+                        help='Requests per second allowed against the API host, shared by all workers.')
+    parser.add_argument('--burst', type=int, default=1, help='Requests that may be sent back to back.')
+    parser.add_argument('--base-url', default=API_BASE_URL, help='SocialStudio API to extract from.')
+    parser.add_argument('--token-file', help='Persist the access token here and reuse it across runs.')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='Extract all profiles on one asyncio event loop, --workers at a time.')
+    parser.add_argument('--tail', action='store_true',
+                        help='Keep polling for new posts, at an interval adapted to the post velocity.')
+    parser.add_argument('--once', action='store_true',
+                        help='With --tail, poll each profile at most once if due and exit (for cron).')
+    parser.add_argument('--shard-days', type=float,
+                        help='Backfill each profile in time shards of this many days, extracted concurrently.')
+    parser.add_argument('--max-posts-per-shard', type=int,
+                        help='With --shard-days, split shards holding more posts than this.')
+    parser.add_argument('--user-agents-file', help='Send the user agents listed in this file, one per line.')
+    parser.add_argument('--pin-user-agent', action='store_true',
+                        help='Send the same user agent with every request instead of rotating them.')
+    parser.add_argument('--metrics-file', help='Keep Prometheus text format metrics of the run in this file.')
+    parser.add_argument('--metrics-log', help='Append a JSON line of metrics to this file at every export.')
+    parser.add_argument('--metrics-interval', type=float, default=15, help='Seconds between metrics exports.')
+    parser.add_argument('--export-only', action='store_true',
+                        help='Only compact the stored posts into the legacy JSON files, without calling the API.')
+    parser.add_argument('--archive', action='store_true',
+                        help='Only write the stored posts into compressed archives chunked by day, '
+                             'without calling the API.')
+    args = parser.parse_args()
+    profile_ids = list(args.profile_ids)
+    if args.profiles_file:
+        profile_ids += load_profile_ids(args.profiles_file)
+    if not profile_ids:
+        parser.error('no profile ids given')
+    if args.export_only:
+        for profile_id in profile_ids:
+            PostExtractor(token_generator=None).export_api_data(profile_id)
+        return
+    if args.archive:
+        for profile_id in profile_ids:
+            PostExtractor(token_generator=None).archive_api_data(profile_id)
+        return
+    user_agent_strategy = UserAgentProvider.PIN if args.pin_user_agent else UserAgentProvider.ROTATE
+    if args.user_agents_file:
+        UserAgentProvider.set_default(UserAgentProvider.from_file(args.user_agents_file, strategy=user_agent_strategy))
+    else:
+        UserAgentProvider.set_default(UserAgentProvider(strategy=user_agent_strategy))
+    if args.metrics_file or args.metrics_log:
+        metrics.enable()
+        if args.metrics_file:
+            metrics.add_exporter(PrometheusTextExporter(args.metrics_file))
+        if args.metrics_log:
+            metrics.add_exporter(JSONLinesExporter(args.metrics_log))
+        metrics.start_exporting(args.metrics_interval)
+    # One connection per worker plus one for token calls keeps every worker on a pooled connection.
+    context = ExtractionContext(base_url=args.base_url, token_file=args.token_file,
+                                rate_limiter=RateLimiter(rate=args.rate, burst=args.burst),
+                                pool_size=max(args.workers + 1, SessionPool.DEFAULT_POOL_SIZE))
+    if args.use_async:
+        try:
+            failed_profiles = AsyncMultiProfileExtractor(context.token_generator, rate_limiter=context.rate_limiter,
+                                                         concurrency=args.workers).write_api_data(profile_ids)
+        finally:
+            metrics.stop_exporting()
+        if failed_profiles:
+            raise SystemExit('Failed profiles: {}'.format(', '.join(failed_profiles)))
+        return
+    request_maker = context.request_maker
+    token_generator = context.token_generator
+    token_generator.start_background_refresh()
+    try:
+        if args.tail:
+            failed_profiles = IncrementalSync(token_generator, request_maker).run(profile_ids, workers=args.workers,
+                                                                                 once=args.once)
+        elif args.shard_days:
+            sharded_backfill = ShardedBackfill(token_generator, request_maker, workers=args.workers,
+                                               shard_days=args.shard_days,
+                                               max_posts_per_shard=args.max_posts_per_shard)
+            for profile_id in profile_ids:
+                sharded_backfill.write_api_data(profile_id)
+            return
+        elif len(profile_ids) == 1:
+            PostExtractor(token_generator, request_maker=request_maker).write_api_data(profile_ids[0])
+            return
+        else:
+            failed_profiles = MultiProfileExtractor(token_generator, request_maker,
+                                                    workers=args.workers).write_api_data(profile_ids)
+    finally:
+        token_generator.stop_background_refresh()
+        metrics.stop_exporting()
+        print('Requests: {}'.format(request_maker.stats.to_dict()))
+    if failed_profiles:
+        raise SystemExit('Failed profiles: {}'.format(', '.join(failed_profiles)))
 
 
 if __name__ == '__main__':
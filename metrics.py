@@ -0,0 +1,217 @@
+import threading
+import time
+from bisect import bisect_left
+
+from utils import JSONUtils, OSFileOperations
+
+# seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# posts per page
+PAGE_SIZE_BUCKETS = (0, 1, 10, 50, 100, 250, 500, 1000)
+# response bodies
+BYTES_BUCKETS = (1 << 10, 1 << 12, 1 << 14, 1 << 16, 1 << 18, 1 << 20, 1 << 22, 1 << 24, 1 << 26)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        # upper bounds, an implicit +Inf bucket follows
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get_cumulative_counts(self):
+        """ (upper bound, observations <= it) pairs, ending with ('+Inf', count)"""
+        cumulative_counts, total = [], 0
+        for upper_bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            cumulative_counts.append((upper_bound, total))
+        return cumulative_counts
+
+
+class NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+
+class Timer:
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.started_at = None
+
+    def __enter__(self):
+        self.started_at = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.metrics.observe(self.name, time.monotonic() - self.started_at, **self.labels)
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Metrics:
+    """
+    Process-wide counters and histograms of the extraction. Disabled, every
+    call returns after a single attribute check, so instrumented code pays
+    next to nothing unless `enable()` was called. Series are identified by a
+    name plus keyword labels, e.g. `metrics.inc('requests_total', status=200)`.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        # (name, sorted label items) -> value
+        self.counters = {}
+        # (name, sorted label items) -> Histogram
+        self.histograms = {}
+        self.exporters = []
+        self.lock = threading.Lock()
+        self.export_thread = None
+        self.stop_exporting_event = threading.Event()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def timer(self, name, **labels):
+        """ Context manager observing its duration in seconds into the histogram `name`"""
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, name, labels)
+
+    def snapshot(self):
+        """ Current values as plain data, histograms with cumulative bucket counts"""
+        with self.lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self.counters.items(), key=self._sort_key)]
+            histograms = [{'name': name, 'labels': dict(labels), 'count': histogram.count, 'sum': histogram.sum,
+                           'buckets': [[upper_bound, count] for upper_bound, count in histogram.get_cumulative_counts()]}
+                          for (name, labels), histogram in sorted(self.histograms.items(), key=self._sort_key)]
+        return {'time': time.time(), 'counters': counters, 'histograms': histograms}
+
+    def add_exporter(self, exporter):
+        """ `exporter` has an `export(snapshot)` method, called by `export()`"""
+        self.exporters.append(exporter)
+
+    def export(self):
+        if not self.enabled or not self.exporters:
+            return
+        snapshot = self.snapshot()
+        for exporter in self.exporters:
+            exporter.export(snapshot)
+
+    def start_exporting(self, interval=15):
+        if self.export_thread:
+            return
+        self.stop_exporting_event.clear()
+        self.export_thread = threading.Thread(target=self._export_periodically, args=(interval,),
+                                              name='metrics-export', daemon=True)
+        self.export_thread.start()
+
+    def stop_exporting(self):
+        """ Stop the export thread, exporting the final values once more"""
+        self.stop_exporting_event.set()
+        if self.export_thread:
+            self.export_thread.join()
+            self.export_thread = None
+        self.export()
+
+    def _export_periodically(self, interval):
+        while not self.stop_exporting_event.wait(interval):
+            try:
+                self.export()
+            except OSError as e:
+                print('Exporting metrics failed: {}'.format(e))
+
+    @staticmethod
+    def _sort_key(item):
+        (name, labels), _ = item
+        return name, [(key, str(value)) for key, value in labels]
+
+
+class PrometheusTextExporter:
+    """ Rewrites `metrics_file` in the Prometheus text format, e.g. for the node_exporter textfile collector"""
+
+    def __init__(self, metrics_file, prefix='socialstudio_'):
+        self.metrics_file = metrics_file
+        self.prefix = prefix
+
+    def export(self, snapshot):
+        lines, typed_names = [], set()
+        for counter in snapshot['counters']:
+            name = self.prefix + counter['name']
+            if name not in typed_names:
+                lines.append('# TYPE {} counter'.format(name))
+                typed_names.add(name)
+            lines.append('{}{} {}'.format(name, self._format_labels(counter['labels']), counter['value']))
+        for histogram in snapshot['histograms']:
+            name = self.prefix + histogram['name']
+            if name not in typed_names:
+                lines.append('# TYPE {} histogram'.format(name))
+                typed_names.add(name)
+            for upper_bound, count in histogram['buckets']:
+                labels = {**histogram['labels'], 'le': upper_bound}
+                lines.append('{}_bucket{} {}'.format(name, self._format_labels(labels), count))
+            labels = self._format_labels(histogram['labels'])
+            lines.append('{}_sum{} {}'.format(name, labels, histogram['sum']))
+            lines.append('{}_count{} {}'.format(name, labels, histogram['count']))
+        # Scrapers must never see a half written file.
+        with OSFileOperations.atomic_open(self.metrics_file) as outfile:
+            outfile.write('\n'.join(lines))
+            outfile.write('\n')
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ''
+        label_pairs = ('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                       for key, value in labels.items())
+        return '{{{}}}'.format(','.join(label_pairs))
+
+
+class JSONLinesExporter:
+    """ Appends every snapshot as one line of `log_file`"""
+
+    def __init__(self, log_file):
+        self.log_file = log_file
+
+    def export(self, snapshot):
+        JSONUtils.append_json_lines(self.log_file, [snapshot])
+
+
+metrics = Metrics()
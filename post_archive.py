@@ -0,0 +1,232 @@
+import argparse
+import gzip
+import io
+from os.path import join
+
+from utils import JSONCodec, JSONUtils, OSFileOperations
+
+try:
+    import zstandard
+except ImportError:
+    # zstd archives need the optional zstandard package, gzip ones work without it.
+    zstandard = None
+
+
+def get_id_key(post_id):
+    """ Sort key ordering numeric ids by value and any other ids consistently"""
+    post_id = str(post_id)
+    return len(post_id), post_id
+
+
+class ArchiveChunk:
+    """ One compressed segment of a PostArchive and its index entry"""
+    EXTENSIONS = {'gzip': 'gz', 'zstd': 'zst'}
+
+    def __init__(self, archive_dir, entry):
+        self.archive_dir = archive_dir
+        self.entry = entry
+
+    @property
+    def chunk_file(self):
+        return join(self.archive_dir, self.entry['file'])
+
+    def overlaps(self, start_date=None, end_date=None):
+        """ Whether posts published in [start_date, end_date) may be in this chunk"""
+        if self.entry['minPublishedDate'] is None:
+            # Posts without dates cannot be ruled out.
+            return True
+        if start_date is not None and self.entry['maxPublishedDate'] < start_date:
+            return False
+        if end_date is not None and self.entry['minPublishedDate'] >= end_date:
+            return False
+        return True
+
+    def may_contain(self, post_id):
+        return get_id_key(self.entry['minId']) <= get_id_key(post_id) <= get_id_key(self.entry['maxId'])
+
+    def iter_lines(self):
+        """ Decompress the chunk as a stream, yielding one serialized post per line"""
+        with open(self.chunk_file, 'rb') as raw_file:
+            if self.entry['compression'] == 'zstd':
+                stream_reader = ArchiveChunk._get_zstandard().ZstdDecompressor().stream_reader(raw_file)
+                compressed_file = io.BufferedReader(stream_reader)
+            else:
+                compressed_file = gzip.GzipFile(fileobj=raw_file, mode='rb')
+            with compressed_file:
+                for line in compressed_file:
+                    if line.strip():
+                        yield line
+
+    def iter_posts(self):
+        for line in self.iter_lines():
+            yield JSONCodec.loads(line)
+
+    @staticmethod
+    def write(archive_dir, chunk_number, lines, posts, compression='gzip', level=None):
+        """ Compress `lines`, the serialized `posts`, into a new chunk file and return its index entry"""
+        file_name = 'chunk_{:06d}.ndjson.{}'.format(chunk_number, ArchiveChunk.EXTENSIONS[compression])
+        content = b''.join(lines)
+        with OSFileOperations.atomic_open(join(archive_dir, file_name), mode='wb') as outfile:
+            if compression == 'zstd':
+                compressor = ArchiveChunk._get_zstandard().ZstdCompressor(level=level if level else 3)
+                outfile.write(compressor.compress(content))
+            else:
+                # mtime=0 keeps chunks of the same posts byte-identical.
+                with gzip.GzipFile(fileobj=outfile, mode='wb', compresslevel=level if level else 6,
+                                   mtime=0) as gzip_file:
+                    gzip_file.write(content)
+        post_ids = [post['id'] for post in posts]
+        published_dates = [post['publishedDate'] for post in posts if post.get('publishedDate') is not None]
+        return {'file': file_name,
+                'compression': compression,
+                'count': len(posts),
+                'firstId': post_ids[0],
+                'lastId': post_ids[-1],
+                'minId': min(post_ids, key=get_id_key),
+                'maxId': max(post_ids, key=get_id_key),
+                'minPublishedDate': min(published_dates) if published_dates else None,
+                'maxPublishedDate': max(published_dates) if published_dates else None,
+                'rawBytes': len(content),
+                'bytes': OSFileOperations.get_file_size(join(archive_dir, file_name))}
+
+    @staticmethod
+    def _get_zstandard():
+        if zstandard is None:
+            raise ValueError('zstd compression needs the zstandard package')
+        return zstandard
+
+
+class PostArchive:
+    """
+    Directory of compressed NDJSON chunks plus an `index.json` recording the
+    post count, id range and publishedDate range of every chunk. Chunks are
+    never modified once written and the index is replaced atomically after
+    each new chunk, so readers always see complete chunks. Readers stream one
+    chunk at a time and skip chunks outside a requested time range.
+    """
+    INDEX_FILE = 'index.json'
+    DAY_MILLIS = 24 * 60 * 60 * 1000
+
+    def __init__(self, archive_dir):
+        self.archive_dir = archive_dir
+        self.index = self._load_index()
+
+    @property
+    def count(self):
+        return self.index['totalCount']
+
+    @property
+    def chunks(self):
+        return [ArchiveChunk(self.archive_dir, entry) for entry in self.index['chunks']]
+
+    @staticmethod
+    def exists(archive_dir):
+        return OSFileOperations.entity_exists(join(archive_dir, PostArchive.INDEX_FILE))
+
+    def iter_posts(self, start_date=None, end_date=None):
+        """ Posts in archive order; with a time range only those published in [start_date, end_date)"""
+        for chunk in self.iter_chunks(start_date, end_date):
+            for post in chunk.iter_posts():
+                if start_date is None and end_date is None:
+                    yield post
+                elif PostArchive.is_published_between(post, start_date, end_date):
+                    yield post
+
+    def iter_chunks(self, start_date=None, end_date=None):
+        for chunk in self.chunks:
+            if chunk.overlaps(start_date, end_date):
+                yield chunk
+
+    def get_post(self, post_id):
+        for chunk in self.chunks:
+            if not chunk.may_contain(post_id):
+                continue
+            for post in chunk.iter_posts():
+                if str(post['id']) == str(post_id):
+                    return post
+        return None
+
+    def append(self, posts, posts_per_chunk=10000, chunk_days=None, compression='gzip', level=None):
+        """
+        Add `posts` as new chunks of at most `posts_per_chunk` posts. With
+        `chunk_days`, a chunk also ends where publishedDate enters the next
+        period of that many days, which suits posts sorted by date.
+        """
+        chunk_millis = int(chunk_days * self.DAY_MILLIS) if chunk_days else None
+        lines, chunk_posts, chunk_period = [], [], None
+        for post in posts:
+            post_period = None
+            if chunk_millis and post.get('publishedDate') is not None:
+                post_period = post['publishedDate'] // chunk_millis
+            if chunk_posts and (len(chunk_posts) >= posts_per_chunk or post_period != chunk_period):
+                self._add_chunk(lines, chunk_posts, compression, level)
+                lines, chunk_posts = [], []
+            chunk_period = post_period
+            lines.append(JSONCodec.dumps(post))
+            lines.append(b'\n')
+            # Only the fields indexed are kept for the index entry.
+            chunk_posts.append({'id': post['id'], 'publishedDate': post.get('publishedDate')})
+        if chunk_posts:
+            self._add_chunk(lines, chunk_posts, compression, level)
+        return self.count
+
+    @staticmethod
+    def write(posts, archive_dir, posts_per_chunk=10000, chunk_days=None, compression='gzip', level=None):
+        """ Build a new archive of `posts`, replacing the one at `archive_dir` only once it is complete"""
+        temp_dir = '{}.tmp'.format(archive_dir)
+        OSFileOperations.remove_entity(temp_dir)
+        archive = PostArchive(temp_dir)
+        archive.append(posts, posts_per_chunk=posts_per_chunk, chunk_days=chunk_days, compression=compression,
+                       level=level)
+        archive.save_index()
+        OSFileOperations.remove_entity(archive_dir)
+        OSFileOperations.rename_entity(temp_dir, archive_dir)
+        return PostArchive(archive_dir)
+
+    def save_index(self):
+        JSONUtils.write_json_data_to_file(join(self.archive_dir, self.INDEX_FILE), self.index)
+
+    @staticmethod
+    def is_published_between(post, start_date=None, end_date=None):
+        published_date = post.get('publishedDate')
+        if published_date is None:
+            return False
+        if start_date is not None and published_date < start_date:
+            return False
+        if end_date is not None and published_date >= end_date:
+            return False
+        return True
+
+    def _add_chunk(self, lines, posts, compression, level):
+        entry = ArchiveChunk.write(self.archive_dir, len(self.index['chunks']), lines, posts,
+                                   compression=compression, level=level)
+        self.index['chunks'].append(entry)
+        self.index['totalCount'] += entry['count']
+        self.save_index()
+
+    def _load_index(self):
+        if PostArchive.exists(self.archive_dir):
+            return JSONUtils.load_json_data_from_file(join(self.archive_dir, self.INDEX_FILE))
+        return {'totalCount': 0, 'chunks': []}
+
+
+def main():
+    # Local import: post_store reads archives through this module.
+    from post_store import PostReader
+    parser = argparse.ArgumentParser(description='Convert a posts dump into a compressed, chunked archive.')
+    parser.add_argument('input_file', help='Legacy JSON dump, NDJSON sink or archive.')
+    parser.add_argument('archive_dir')
+    parser.add_argument('--posts-per-chunk', type=int, default=10000)
+    parser.add_argument('--chunk-days', type=float, help='Also start a new chunk every this many days of posts.')
+    parser.add_argument('--compression', choices=sorted(ArchiveChunk.EXTENSIONS), default='gzip')
+    parser.add_argument('--level', type=int, help='Compression level.')
+    args = parser.parse_args()
+    archive = PostArchive.write(PostReader.iter_posts(args.input_file), args.archive_dir,
+                                posts_per_chunk=args.posts_per_chunk, chunk_days=args.chunk_days,
+                                compression=args.compression, level=args.level)
+    compressed_bytes = sum(chunk.entry['bytes'] for chunk in archive.chunks)
+    print('{} posts in {} chunks, {} bytes'.format(archive.count, len(archive.chunks), compressed_bytes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+import mmap
+from array import array
+from collections import Counter
+from os.path import join
+
+from utils import JSONUtils, OSFileOperations
+
+
+def has_dynamics(post):
+    for dynamics in post['postDynamics']:
+        if dynamics['value'] != '0':
+            return True
+    return False
+
+
+class PostFlags:
+    """ Bits of the `flags` column, one per yes/no question the reports ask about a post"""
+    CONTENT = 1
+    ROOT = 2
+    PARENT = 4
+    AUTHOR_NAME = 8
+    AVATAR = 16
+    DYNAMICS = 32
+
+    @staticmethod
+    def of(post):
+        flags = 0
+        if post['content']:
+            flags |= PostFlags.CONTENT
+        if post['parent'] is None:
+            flags |= PostFlags.ROOT
+        if post['parent']:
+            flags |= PostFlags.PARENT
+        if post['author']['authorFullName']:
+            flags |= PostFlags.AUTHOR_NAME
+        if post['author']['avatar']:
+            flags |= PostFlags.AVATAR
+        if has_dynamics(post):
+            flags |= PostFlags.DYNAMICS
+        return flags
+
+
+class PostColumns:
+    """
+    Compact columnar copy of a posts dump holding only what the reports read:
+    dictionary-encoded `postType` and domain columns plus a `flags` byte per
+    post. Columns are flat binary arrays that are memory-mapped when read, so
+    grouping millions of posts needs neither the JSON nor the post dicts.
+    """
+    POST_TYPE_FILE = 'post_type.i32'
+    DOMAIN_FILE = 'domain.i32'
+    FLAGS_FILE = 'flags.u8'
+    DICTIONARY_FILE = 'dictionary.json'
+
+    def __init__(self, columns_dir):
+        self.columns_dir = columns_dir
+        self.dictionary = JSONUtils.load_json_data_from_file(join(columns_dir, self.DICTIONARY_FILE))
+
+    @property
+    def count(self):
+        return self.dictionary['count']
+
+    @property
+    def profile_id(self):
+        return self.dictionary['profileId']
+
+    @staticmethod
+    def exists(columns_dir):
+        return OSFileOperations.entity_exists(join(columns_dir, PostColumns.DICTIONARY_FILE))
+
+    @staticmethod
+    def ingest(posts, columns_dir, get_domains, batch_size=100000):
+        """ Convert an iterable of posts into columns under `columns_dir`, replacing what was there"""
+        OSFileOperations.remove_entity(columns_dir)
+        OSFileOperations.ensure_directory(join(columns_dir, PostColumns.DICTIONARY_FILE))
+        post_type_codes, domain_codes = {}, {}
+        dictionary = {'count': 0, 'profileId': None}
+        batch = []
+        for post in posts:
+            if dictionary['profileId'] is None:
+                dictionary['profileId'] = post['topics'][0]
+            batch.append(post)
+            if len(batch) >= batch_size:
+                PostColumns._write_batch(columns_dir, batch, get_domains, post_type_codes, domain_codes)
+                dictionary['count'] += len(batch)
+                batch = []
+        PostColumns._write_batch(columns_dir, batch, get_domains, post_type_codes, domain_codes)
+        dictionary['count'] += len(batch)
+        # dicts keep insertion order, so position in these lists is the code and the first-seen order.
+        dictionary['postTypes'] = list(post_type_codes)
+        dictionary['domains'] = list(domain_codes)
+        # Written last: columns without a dictionary are an interrupted ingest.
+        JSONUtils.write_json_data_to_file(join(columns_dir, PostColumns.DICTIONARY_FILE), dictionary)
+        return PostColumns(columns_dir)
+
+    def group_counts(self):
+        """ Number of posts per (postType, domain, flags), in order of first appearance"""
+        if not self.count:
+            return Counter()
+        with open(join(self.columns_dir, self.POST_TYPE_FILE), 'rb') as post_type_file, \
+                open(join(self.columns_dir, self.DOMAIN_FILE), 'rb') as domain_file, \
+                open(join(self.columns_dir, self.FLAGS_FILE), 'rb') as flags_file:
+            with mmap.mmap(post_type_file.fileno(), 0, access=mmap.ACCESS_READ) as post_type_map, \
+                    mmap.mmap(domain_file.fileno(), 0, access=mmap.ACCESS_READ) as domain_map, \
+                    mmap.mmap(flags_file.fileno(), 0, access=mmap.ACCESS_READ) as flags_map:
+                post_type_column = memoryview(post_type_map).cast('i')
+                domain_column = memoryview(domain_map).cast('i')
+                flags_column = memoryview(flags_map)
+                try:
+                    # zip and Counter both run in C, no post object is built per row.
+                    code_counts = Counter(zip(post_type_column, domain_column, flags_column))
+                finally:
+                    post_type_column.release()
+                    domain_column.release()
+                    flags_column.release()
+        post_types = self.dictionary['postTypes']
+        domains = self.dictionary['domains']
+        group_counts = Counter()
+        for (post_type_code, domain_code, flags), count in code_counts.items():
+            group_counts[(post_types[post_type_code], domains[domain_code], flags)] = count
+        return group_counts
+
+    @staticmethod
+    def _write_batch(columns_dir, posts, get_domains, post_type_codes, domain_codes):
+        domains = get_domains([post['externalLink'] for post in posts])
+        post_type_column, domain_column, flags_column = array('i'), array('i'), array('B')
+        for post, domain in zip(posts, domains):
+            post_type_column.append(post_type_codes.setdefault(post['postType'], len(post_type_codes)))
+            domain_column.append(domain_codes.setdefault(domain, len(domain_codes)))
+            flags_column.append(PostFlags.of(post))
+        PostColumns._append_column(join(columns_dir, PostColumns.POST_TYPE_FILE), post_type_column)
+        PostColumns._append_column(join(columns_dir, PostColumns.DOMAIN_FILE), domain_column)
+        PostColumns._append_column(join(columns_dir, PostColumns.FLAGS_FILE), flags_column)
+
+    @staticmethod
+    def _append_column(column_file, values):
+        with open(column_file, 'ab') as file:
+            values.tofile(file)
@@ -0,0 +1,332 @@
+import os
+import sqlite3
+import threading
+from operator import itemgetter
+
+from post_archive import PostArchive
+from utils import JSONCodec, JSONUtils, OSFileOperations
+
+
+class PostSink:
+    """
+    Append-only store for extracted posts: one post per line in `data_file`
+    and a small sidecar next to it holding the legacy `meta` block, so adding
+    a page costs the same no matter how many posts were stored before it.
+    """
+
+    def __init__(self, data_file):
+        self.data_file = data_file
+        self.meta_file = '{}.meta.json'.format(data_file)
+        self.meta = self._load_meta()
+
+    @property
+    def count(self):
+        return self.meta['totalCount']
+
+    @property
+    def size(self):
+        return OSFileOperations.get_file_size(self.data_file)
+
+    def append(self, posts, fsync=False):
+        if not posts:
+            return
+        JSONUtils.append_json_lines(self.data_file, posts, fsync=fsync)
+        self.meta['totalCount'] += len(posts)
+        JSONUtils.write_json_data_to_file(self.meta_file, self.meta)
+
+    def append_lines(self, lines):
+        """ Append posts already serialized with JSONCodec, one per item of `lines`"""
+        if not lines:
+            return
+        OSFileOperations.ensure_directory(self.data_file)
+        with open(self.data_file, 'ab') as outfile:
+            outfile.write(b'\n'.join(lines))
+            outfile.write(b'\n')
+        self.meta['totalCount'] += len(lines)
+        JSONUtils.write_json_data_to_file(self.meta_file, self.meta)
+
+    def rollback(self, size, count):
+        """ Drop everything appended after the sink held `count` posts in `size` bytes"""
+        if self.size > size:
+            with open(self.data_file, 'r+') as file:
+                file.truncate(size)
+        if self.count != count:
+            self.meta['totalCount'] = count
+            JSONUtils.write_json_data_to_file(self.meta_file, self.meta)
+
+    def iter_posts(self):
+        if not OSFileOperations.entity_exists(self.data_file):
+            return iter(())
+        return JSONUtils.iter_json_lines(self.data_file)
+
+    def import_legacy(self, json_file):
+        """ Seed an empty sink from a `{'data': [...], 'meta': {...}}` dump written by older versions"""
+        if self.count or not OSFileOperations.entity_exists(json_file):
+            return
+        legacy_data = JSONUtils.load_json_data_from_file(json_file)
+        self.append(legacy_data['data'])
+
+    def export(self, output_file):
+        PostSink.export_many([self], output_file)
+
+    @staticmethod
+    def export_many(sinks, output_file):
+        """ Compact one or more sinks into a single file in the legacy `{'data': [...], 'meta': {...}}` layout"""
+        total_count = 0
+        # Downstream jobs read the legacy file, so it is only replaced once it was written completely.
+        with OSFileOperations.atomic_open(output_file, mode='wb') as outfile:
+            outfile.write(b'{"data":[')
+            separator = b''
+            for sink in sinks:
+                if not OSFileOperations.entity_exists(sink.data_file):
+                    continue
+                with open(sink.data_file, 'rb') as infile:
+                    for line in infile:
+                        line = line.strip()
+                        if not line:
+                            continue
+                        # Every line is one serialized post, so it can be copied verbatim.
+                        outfile.write(separator)
+                        outfile.write(line)
+                        separator = b','
+                        total_count += 1
+            outfile.write(b'],"meta":')
+            outfile.write(JSONCodec.dumps({'totalCount': total_count}))
+            outfile.write(b'}')
+        return total_count
+
+    def _load_meta(self):
+        if OSFileOperations.entity_exists(self.meta_file):
+            return JSONUtils.load_json_data_from_file(self.meta_file)
+        return {'totalCount': 0}
+
+
+class Checkpoint:
+    """
+    Commit point of a paginated extraction. Committing a page records the
+    parameters of the next page together with the size and post count of every
+    sink in the state file (replaced atomically), and adds the page to an
+    append-only journal. Loading rolls the sinks back to the last commit, so a
+    killed job re-downloads at most the page it was writing.
+
+    `fsync_every` controls durability: sinks and state are fsynced every that
+    many pages, 0 leaves flushing to the OS. Pages committed without fsync may
+    be lost on power failure; loading then falls back to the newest journal
+    entry whose data is still on disk.
+    """
+
+    # Bytes read at a time when looking for the last journal entry from the end of the file.
+    JOURNAL_TAIL_BLOCK_SIZE = 4096
+
+    def __init__(self, state_file, journal_file, sinks, fsync_every=1):
+        self.state_file = state_file
+        self.journal_file = journal_file
+        # name -> PostSink
+        self.sinks = sinks
+        self.fsync_every = fsync_every
+        self.page = 0
+        # ids of the posts the last committed page added to the sinks
+        self.stored_ids = []
+        # Whether `load` dropped committed pages whose data did not reach the disk.
+        self.rolled_back = False
+        # parameters of the last commit
+        self.params = None
+
+    def load(self):
+        """ Return the parameters to resume from, or None if nothing was committed yet"""
+        self.rolled_back = False
+        if not OSFileOperations.entity_exists(self.state_file):
+            return None
+        state = JSONUtils.load_json_data_from_file(self.state_file)
+        if 'params' not in state:
+            # State written before checkpoints existed holds the bare request parameters.
+            return state
+        if not self._is_on_disk(state):
+            self.rolled_back = True
+            state = self._last_entry_on_disk()
+            if state is None:
+                # Nothing committed survived, start over with empty sinks rather than duplicating posts.
+                for sink in self.sinks.values():
+                    sink.rollback(0, 0)
+                return None
+        self._restore(state)
+        return state['params']
+
+    def commit(self, params, page_ids, stored_ids=()):
+        """ `stored_ids` are kept with the state, so an index updated after the commit can be caught up on resume"""
+        if not page_ids and params == self.params:
+            # An empty page that did not move the cursor, e.g. a poll without new posts, changes nothing.
+            return
+        stored_ids = list(stored_ids)
+        self.page += 1
+        fsync = bool(self.fsync_every) and self.page % self.fsync_every == 0
+        if fsync:
+            for sink in self.sinks.values():
+                OSFileOperations.fsync_file(sink.data_file)
+        state = {'page': self.page,
+                 'firstId': page_ids[0] if page_ids else None,
+                 'lastId': page_ids[-1] if page_ids else None,
+                 'count': len(page_ids),
+                 'params': params,
+                 'sinks': {name: {'size': sink.size, 'count': sink.count} for name, sink in self.sinks.items()}}
+        JSONUtils.write_json_data_to_file(self.state_file, {**state, 'storedIds': stored_ids}, fsync=fsync)
+        JSONUtils.append_json_lines(self.journal_file, [state], fsync=fsync)
+        self.stored_ids = stored_ids
+        self.params = params
+
+    def _restore(self, state):
+        for name, sink_state in state['sinks'].items():
+            if name in self.sinks:
+                self.sinks[name].rollback(sink_state['size'], sink_state['count'])
+        self.page = state['page']
+        self.params = state['params']
+        self.stored_ids = state.pop('storedIds', [])
+        journal_tail = self._last_journal_entry()
+        if journal_tail is None or journal_tail['page'] < state['page']:
+            # Killed between replacing the state and appending to the journal.
+            JSONUtils.append_json_lines(self.journal_file, [state])
+
+    def _is_on_disk(self, state):
+        for name, sink_state in state['sinks'].items():
+            if name in self.sinks and self.sinks[name].size < sink_state['size']:
+                return False
+        return True
+
+    def _iter_journal(self):
+        if not OSFileOperations.entity_exists(self.journal_file):
+            return
+        with open(self.journal_file, 'rb') as file:
+            for line in file:
+                entry = self._parse_journal_line(line)
+                if entry is not None:
+                    yield entry
+
+    def _last_journal_entry(self):
+        """ The last readable journal entry, read backwards from the end so resuming does not grow with the journal"""
+        if not OSFileOperations.entity_exists(self.journal_file):
+            return None
+        with open(self.journal_file, 'rb') as file:
+            position = file.seek(0, os.SEEK_END)
+            remainder = b''
+            while position > 0:
+                read_size = min(self.JOURNAL_TAIL_BLOCK_SIZE, position)
+                position -= read_size
+                file.seek(position)
+                lines = (file.read(read_size) + remainder).split(b'\n')
+                # The first line may start in the block before this one.
+                remainder = lines.pop(0) if position else b''
+                for line in reversed(lines):
+                    entry = self._parse_journal_line(line)
+                    if entry is not None:
+                        return entry
+        return None
+
+    @staticmethod
+    def _parse_journal_line(line):
+        if not line.strip():
+            return None
+        try:
+            return JSONCodec.loads(line)
+        except ValueError:
+            # A torn line left by a crash before the journal was fsynced.
+            return None
+
+    def _last_entry_on_disk(self):
+        last_entry = None
+        for entry in self._iter_journal():
+            if self._is_on_disk(entry):
+                last_entry = entry
+        return last_entry
+
+
+class PostIndex:
+    """
+    Persistent set of post ids, backed by SQLite so membership checks stay
+    cheap without loading the history into memory. Use ':memory:' for an index
+    that only lives as long as the object.
+    """
+    # SQLite limits the number of bound parameters of a statement.
+    QUERY_BATCH_SIZE = 500
+
+    def __init__(self, index_file=':memory:'):
+        if index_file != ':memory:':
+            OSFileOperations.ensure_directory(index_file)
+        self.index_file = index_file
+        self.connection = sqlite3.connect(index_file, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS seen_posts (id TEXT PRIMARY KEY) WITHOUT ROWID')
+        self.connection.commit()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM seen_posts').fetchone()[0]
+
+    def __contains__(self, post_id):
+        with self.lock:
+            row = self.connection.execute('SELECT 1 FROM seen_posts WHERE id = ?', (str(post_id),)).fetchone()
+        return row is not None
+
+    def filter_new(self, posts, get_id=itemgetter('id')):
+        """ Posts whose ids are neither in the index nor repeated earlier in `posts`"""
+        seen_ids = self._get_seen_ids([str(get_id(post)) for post in posts])
+        new_posts = []
+        for post in posts:
+            post_id = str(get_id(post))
+            if post_id not in seen_ids:
+                seen_ids.add(post_id)
+                new_posts.append(post)
+        return new_posts
+
+    def add(self, post_ids):
+        with self.lock:
+            self.connection.executemany('INSERT OR IGNORE INTO seen_posts (id) VALUES (?)',
+                                        ((str(post_id),) for post_id in post_ids))
+            self.connection.commit()
+
+    def seed(self, posts, batch_size=10000):
+        """ Index the ids of already stored posts, e.g. a sink written before the index existed"""
+        batch = []
+        for post in posts:
+            batch.append(post['id'])
+            if len(batch) >= batch_size:
+                self.add(batch)
+                batch = []
+        self.add(batch)
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute('DELETE FROM seen_posts')
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def _get_seen_ids(self, post_ids):
+        seen_ids = set()
+        with self.lock:
+            for start in range(0, len(post_ids), self.QUERY_BATCH_SIZE):
+                batch = post_ids[start:start + self.QUERY_BATCH_SIZE]
+                query = 'SELECT id FROM seen_posts WHERE id IN ({})'.format(', '.join('?' * len(batch)))
+                seen_ids.update(row[0] for row in self.connection.execute(query, batch))
+        return seen_ids
+
+
+class PostReader:
+    @staticmethod
+    def iter_posts(input_file, start_date=None, end_date=None):
+        """
+        Stream the posts of a PostArchive, an NDJSON sink or a legacy
+        `{'data': [...], 'meta': {...}}` dump. With a time range only posts
+        published in [start_date, end_date) are returned; archives skip the
+        chunks outside of it without decompressing them.
+        """
+        if PostArchive.exists(input_file):
+            return PostArchive(input_file).iter_posts(start_date, end_date)
+        if input_file.endswith('.ndjson'):
+            posts = JSONUtils.iter_json_lines(input_file)
+        else:
+            posts = JSONUtils.iter_json_array_items(input_file, key='data')
+        if start_date is None and end_date is None:
+            return posts
+        return (post for post in posts if PostArchive.is_published_between(post, start_date, end_date))
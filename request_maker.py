@@ -1,12 +1,20 @@
 import random
+import threading
 import time
-from datetime import datetime
+from collections import Counter
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from typing import Dict
 from urllib.parse import urlsplit
 
-import requests
-from fake_useragent import UserAgent
-from requests import Response
+from metrics import BYTES_BUCKETS, metrics
+from user_agents import UserAgentProvider
+from utils import JSONCodec, LazyModule
+
+# Imported on the first request, they are the bulk of the import time of the extraction modules.
+aiohttp = LazyModule('aiohttp')
+asyncio = LazyModule('asyncio')
+requests = LazyModule('requests')
 
 
 class RequestsTimeout:
@@ -16,89 +24,605 @@ class RequestsTimeout:
     TIMEOUT_TUPLE = (CONNECTION_TIMEOUT, READ_TIMEOUT)
 
 
-class Throttle:
-    def __init__(self, delay=60):
-        # amount of delay between downloads for each domain
-        self.delay = delay
-        # timestamp of when a domain was last accessed
-        self.domains = {}
+class SessionPool:
+    """
+    Long-lived `requests` sessions shared by every RequestMaker of the process,
+    so connections (and their TLS handshakes) are reused across pages, token
+    calls and threads.
+    """
+    DEFAULT_POOL_SIZE = 10
+
+    _sessions = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get_session(pool_size=DEFAULT_POOL_SIZE):
+        with SessionPool._lock:
+            session = SessionPool._sessions.get(pool_size)
+            if session is None:
+                session = SessionPool._create_session(pool_size)
+                SessionPool._sessions[pool_size] = session
+            return session
+
+    @staticmethod
+    def close_all():
+        with SessionPool._lock:
+            for session in SessionPool._sessions.values():
+                session.close()
+            SessionPool._sessions.clear()
+
+    @staticmethod
+    def _create_session(pool_size):
+        session = requests.Session()
+        # pool_connections is the number of hosts kept, pool_maxsize the connections kept per host.
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update({'Accept-Encoding': 'gzip, deflate',
+                                'Connection': 'keep-alive'})
+        return session
+
+
+class TokenBucket:
+    """
+    Allows `rate` requests per second with bursts of up to `burst` requests.
+    Callers take a token up front and sleep off any debt, so concurrent callers
+    are spaced out instead of waking up together.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def reserve(self):
+        """ Take a token and return the seconds to wait before using it"""
+        self._refill()
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def hold(self, seconds):
+        """ Hand out no tokens for the next `seconds`"""
+        self._refill()
+        self.tokens = min(self.tokens, 0)
+        self.updated_at += seconds
+
+    def _refill(self):
+        now = time.monotonic()
+        # updated_at lies in the future while the bucket is held back by a Retry-After.
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def slow_down(self, min_rate):
+        self._refill()
+        self.rate = max(min_rate, self.rate / 2)
+
+    def speed_up(self):
+        self._refill()
+        self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+
+class RateLimiter:
+    """ Thread-safe token bucket per host, adapting to 429 responses of that host"""
+
+    def __init__(self, rate=1.0, burst=1, min_rate=None, default_retry_after=30):
+        # requests per second allowed for each host, None disables limiting
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate if min_rate else (rate / 16 if rate else None)
+        self.default_retry_after = default_retry_after
+        self.buckets = {}
+        self.lock = threading.Lock()
 
     def wait(self, url):
-        """ Delay if have accessed this domain recently"""
-        domain = urlsplit(url).netloc
-        last_accessed = self.domains.get(domain)
-        if self.delay > 0 and last_accessed is not None:
-            sleep_secs = self.delay - (datetime.now() - last_accessed).seconds
-            print("Sleeping for: ", sleep_secs)
-            if sleep_secs > 0:
-                time.sleep(sleep_secs)
-        self.domains[domain] = datetime.now()
+        """ Delay until the host of `url` has budget for another request"""
+        sleep_secs = self.reserve(url)
+        if sleep_secs > 0:
+            print("Sleeping for: ", round(sleep_secs, 3))
+            time.sleep(sleep_secs)
+
+    async def wait_async(self, url):
+        sleep_secs = self.reserve(url)
+        if sleep_secs > 0:
+            print("Sleeping for: ", round(sleep_secs, 3))
+            await asyncio.sleep(sleep_secs)
+
+    def reserve(self, url):
+        """ Take budget for a request to the host of `url`, returning the seconds to wait before sending it"""
+        if not self.rate:
+            return 0
+        with self.lock:
+            return self._get_bucket(url).reserve()
+
+    def throttled(self, url, retry_after=None):
+        """ Back off after the host answered 429 Too Many Requests"""
+        if not self.rate:
+            return
+        with self.lock:
+            bucket = self._get_bucket(url)
+            bucket.slow_down(self.min_rate)
+            bucket.hold(retry_after if retry_after is not None else self.default_retry_after)
+
+    def succeeded(self, url):
+        if not self.rate:
+            return
+        with self.lock:
+            self._get_bucket(url).speed_up()
+
+    def _get_bucket(self, url):
+        host = urlsplit(url).netloc
+        bucket = self.buckets.get(host)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+            self.buckets[host] = bucket
+        return bucket
+
+
+def parse_retry_after(value):
+    """ Seconds to wait according to a Retry-After header, given either as seconds or as an HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0)
+
+
+class CircuitBreaker:
+    """
+    Holds back requests to a host after `failure_threshold` consecutive
+    failed attempts (5xx-like statuses and connection errors), so a host that
+    is down is not hammered by every retry of every page. Callers wait while
+    the circuit is open; after `reset_timeout` seconds a single trial request
+    is let through: its success closes the circuit and releases the waiting
+    callers, its failure opens it again.
+    """
+    # Seconds between checks of callers waiting for the trial request.
+    TRIAL_POLL_INTERVAL = 1
+
+    def __init__(self, failure_threshold=10, reset_timeout=60):
+        # None never opens the circuit
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        # host -> {'failures', 'openedAt', 'trialAt'}
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def before_request(self, url):
+        """ Block while requests to the host of `url` are held back"""
+        wait_secs = self.get_wait(url)
+        if not wait_secs:
+            return
+        with metrics.timer('circuit_wait_seconds'):
+            while wait_secs:
+                time.sleep(wait_secs)
+                wait_secs = self.get_wait(url)
+
+    async def before_request_async(self, url):
+        wait_secs = self.get_wait(url)
+        if not wait_secs:
+            return
+        with metrics.timer('circuit_wait_seconds'):
+            while wait_secs:
+                await asyncio.sleep(wait_secs)
+                wait_secs = self.get_wait(url)
+
+    def get_wait(self, url):
+        """ 0 if a request to the host of `url` may be sent now, else the seconds to wait before asking again"""
+        host = urlsplit(url).netloc
+        with self.lock:
+            state = self.hosts.get(host)
+            if state is None or state['openedAt'] is None:
+                return 0
+            now = time.monotonic()
+            seconds_left = state['openedAt'] + self.reset_timeout - now
+            if seconds_left > 0:
+                return seconds_left
+            if state['trialAt'] is not None and now - state['trialAt'] < self.reset_timeout:
+                # Wait for the outcome of the trial request; a trial that never reported back is replaced.
+                return min(self.TRIAL_POLL_INTERVAL, self.reset_timeout - (now - state['trialAt']))
+            state['trialAt'] = now
+            return 0
+
+    def succeeded(self, url):
+        with self.lock:
+            self.hosts.pop(urlsplit(url).netloc, None)
+
+    def failed(self, url):
+        if not self.failure_threshold:
+            return
+        host = urlsplit(url).netloc
+        with self.lock:
+            state = self.hosts.setdefault(host, {'failures': 0, 'openedAt': None, 'trialAt': None})
+            state['failures'] += 1
+            state['trialAt'] = None
+            if state['failures'] >= self.failure_threshold:
+                if state['openedAt'] is None:
+                    metrics.inc('circuit_opened_total')
+                    print('Circuit opened for {} after {} failed attempts'.format(host, state['failures']))
+                state['openedAt'] = time.monotonic()
+
+
+class RetryPolicy:
+    """
+    Which responses are retried and how long to wait before the next attempt.
+    Retryable statuses and connection errors back off exponentially with full
+    jitter, at least as long as a Retry-After header asks for; 401 is retried
+    once with a refreshed token; any other status below 500 fails at once.
+    Share one policy between request makers to share its circuit breaker.
+    """
+    SUCCESS = 'success'
+    RETRY = 'retry'
+    REFRESH = 'refresh'
+    FAIL = 'fail'
+
+    RETRYABLE_STATUS_CODES = frozenset([408, 425, 429])
+
+    def __init__(self, max_attempts=5, base_delay=1, max_delay=60, circuit_breaker=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.circuit_breaker = circuit_breaker if circuit_breaker else CircuitBreaker()
+
+    def classify(self, status_code):
+        if 200 <= status_code < 300:
+            return self.SUCCESS
+        if status_code == 401:
+            return self.REFRESH
+        if status_code in self.RETRYABLE_STATUS_CODES or status_code >= 500:
+            return self.RETRY
+        return self.FAIL
+
+    def get_delay(self, attempt, retry_after=None):
+        """ Seconds to wait after the `attempt`-th attempt failed"""
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        if retry_after is not None:
+            return max(retry_after, backoff)
+        return backoff
+
+
+class RequestStats:
+    """ Thread-safe counters of the requests sent by a request maker"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        # requests given up on, after their last attempt or a non-retryable status
+        self.failures = 0
+        self.errors = 0
+        self.token_refreshes = 0
+        self.status_counts = Counter()
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def record_attempt(self, status_code, latency):
+        """ `status_code` is None for attempts that raised a connection error"""
+        with self.lock:
+            self.requests += 1
+            if status_code is None:
+                self.errors += 1
+            else:
+                self.status_counts[status_code] += 1
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+
+    def record_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+
+    def record_token_refresh(self):
+        with self.lock:
+            self.token_refreshes += 1
+
+    def to_dict(self):
+        with self.lock:
+            return {'requests': self.requests,
+                    'retries': self.retries,
+                    'failures': self.failures,
+                    'errors': self.errors,
+                    'tokenRefreshes': self.token_refreshes,
+                    'statusCounts': dict(self.status_counts),
+                    'latencyMean': self.latency_total / self.requests if self.requests else 0,
+                    'latencyMax': self.latency_max}
 
 
 class WebScraperUtility:
-    def __init__(self, delay=5):
-        self.headers = []
-        self.throttle = Throttle(delay=delay)
+    def __init__(self, delay=5, rate_limiter=None, retry_policy=None, user_agent_provider=None):
+        self.rate_limiter = rate_limiter if rate_limiter else RateLimiter(rate=1.0 / delay if delay else None)
+        self.retry_policy = retry_policy if retry_policy else RetryPolicy()
+        self.user_agent_provider = user_agent_provider if user_agent_provider else UserAgentProvider.get_default()
 
     def get_useragent(self):
-        ua = UserAgent()
-        self.headers = [ua.chrome, ua.google,
-                        ua['google chrome'], ua.firefox, ua.ff]
-        return {'User-Agent': random.choice(self.headers)}
+        return self.user_agent_provider.get_header()
+
+    def get_headers(self, extra_header):
+        return {**self.get_useragent(), **extra_header}
 
     def wait(self, url):
         """ Delay if have accessed this domain recently"""
-        self.throttle.wait(url)
+        self.retry_policy.circuit_breaker.before_request(url)
+        with metrics.timer('request_throttle_seconds'):
+            self.rate_limiter.wait(url)
+
+    async def wait_async(self, url):
+        await self.retry_policy.circuit_breaker.before_request_async(url)
+        with metrics.timer('request_throttle_seconds'):
+            await self.rate_limiter.wait_async(url)
+
+    def check_page(self, url, page):
+        """ RetryPolicy outcome of `page` and the Retry-After it asked for, if any"""
+        outcome = self.retry_policy.classify(page.status_code)
+        retry_after = None
+        if outcome == RetryPolicy.RETRY:
+            # A 503 may ask for a delay as well as a 429.
+            retry_after = parse_retry_after(page.headers.get('Retry-After'))
+        if page.status_code == 429:
+            # The host is up but throttling us, which the rate limiter and the backoff deal with.
+            self.retry_policy.circuit_breaker.succeeded(url)
+            self.rate_limiter.throttled(url, retry_after)
+        elif outcome == RetryPolicy.RETRY:
+            self.retry_policy.circuit_breaker.failed(url)
+        else:
+            # Any answer but a retryable one shows the host is up.
+            self.retry_policy.circuit_breaker.succeeded(url)
+            if outcome == RetryPolicy.SUCCESS:
+                self.rate_limiter.succeeded(url)
+        return outcome, retry_after
+
+    def record_attempt(self, page, latency):
+        """ Metrics of one attempt, `page` is None if it raised a connection error"""
+        if not metrics.enabled:
+            return
+        metrics.observe('request_seconds', latency)
+        if page is None:
+            metrics.inc('requests_total', status='error')
+            return
+        metrics.inc('requests_total', status=page.status_code)
+        metrics.observe('response_bytes', len(page.content), buckets=BYTES_BUCKETS)
+
+    def check_error(self, url):
+        self.retry_policy.circuit_breaker.failed(url)
+
+    def get_retry_delay(self, attempt, retry_after=None):
+        return self.retry_policy.get_delay(attempt, retry_after)
+
+
+class RequestAttempts:
+    """
+    The attempts of one request: records every answer and decides whether to
+    return it, refresh the token and resend at once, or sleep and retry.
+    RequestMaker and AsyncRequestMaker share it and only differ in how they
+    send, refresh and sleep.
+    """
+
+    def __init__(self, scrape_utility, stats, url, retry=None):
+        self.scrape_utility = scrape_utility
+        self.stats = stats
+        self.url = url
+        self.attempts = retry if retry else scrape_utility.retry_policy.max_attempts
+        self.attempt = 0
+        self.token_refreshed = False
+        self.status_message = None
+        self.started_at = None
+
+    def start(self):
+        """ Call right before sending an attempt"""
+        self.attempt += 1
+        self.started_at = time.monotonic()
+
+    def failed(self, error):
+        """ The attempt raised a connection error: (RETRY, seconds to sleep), raises ValueError once out of attempts"""
+        latency = time.monotonic() - self.started_at
+        self.stats.record_attempt(None, latency)
+        self.scrape_utility.record_attempt(None, latency)
+        self.scrape_utility.check_error(self.url)
+        print(error)
+        self.status_message = 'RequestException {reason} for URL: {url}'.format(reason=error, url=self.url)
+        return self._retry()
+
+    def answered(self, page, auth=None):
+        """
+        (SUCCESS, None) to return `page`, (REFRESH, None) to resend with a
+        fresh token from `auth`, or (RETRY, seconds to sleep); raises
+        ValueError once the request is given up
+        """
+        latency = time.monotonic() - self.started_at
+        self.stats.record_attempt(page.status_code, latency)
+        self.scrape_utility.record_attempt(page, latency)
+        self.status_message = 'Status: {status}, {reason} for URL: {url}'.format(status=page.status_code,
+                                                                                 reason=page.reason, url=self.url)
+        outcome, retry_after = self.scrape_utility.check_page(self.url, page)
+        if outcome == RetryPolicy.SUCCESS:
+            return RetryPolicy.SUCCESS, None
+        if outcome == RetryPolicy.REFRESH and auth and not self.token_refreshed and self.attempt < self.attempts:
+            print(" Status code :{status}, refreshing the access token".format(status=page.status_code))
+            self.token_refreshed = True
+            self.stats.record_token_refresh()
+            metrics.inc('token_refreshes_total', reason='unauthorized')
+            return RetryPolicy.REFRESH, None
+        if outcome != RetryPolicy.RETRY:
+            self._give_up()
+        return self._retry(retry_after)
+
+    def _retry(self, retry_after=None):
+        if self.attempt >= self.attempts:
+            self._give_up()
+        self.stats.record_retry()
+        sleep_secs = self.scrape_utility.get_retry_delay(self.attempt, retry_after)
+        metrics.inc('request_retries_total')
+        metrics.observe('request_backoff_seconds', sleep_secs)
+        print("Retrying {url} in {secs}s".format(url=self.url, secs=round(sleep_secs, 3)))
+        return RetryPolicy.RETRY, sleep_secs
+
+    def _give_up(self):
+        self.stats.record_failure()
+        metrics.inc('request_failures_total')
+        raise ValueError(self.status_message)
 
 
 class RequestMaker:
-    def __init__(self, header=None, delay=10):
+    """
+    Sends requests through the shared session, retrying according to
+    `retry_policy`. Pass a token provider as `auth` (anything with
+    `get_header()` and `invalidate(authorization)`, like TokenGenerator) to
+    have a 401 answered with a fresh token instead of a failure.
+    """
+
+    def __init__(self, header=None, delay=10, rate_limiter=None, pool_size=SessionPool.DEFAULT_POOL_SIZE,
+                 retry_policy=None, user_agent_provider=None):
         self.delay = delay
-        self.scrape_utility = WebScraperUtility(delay=delay)
+        self.scrape_utility = WebScraperUtility(delay=delay, rate_limiter=rate_limiter, retry_policy=retry_policy,
+                                                user_agent_provider=user_agent_provider)
+        self.pool_size = pool_size
         self.proxy_dict = None
         self.extra_header = header if header else {}
+        self.stats = RequestStats()
 
-    def _make_request(self, url, request_method, parameters, retry, header=None):
-        i = 0
-        base_header = self.scrape_utility.get_useragent()
-        extra_header = header if header else self.extra_header
-        headers = {**base_header, **extra_header}
-        status_message = None
+    @property
+    def session(self):
+        # Taken from the pool when the first request is sent, which is also when `requests` gets imported.
+        return SessionPool.get_session(self.pool_size)
+
+    def _make_request(self, url, request_method, parameters, retry, header=None, auth=None):
+        headers = self.scrape_utility.get_headers(header if header else self.extra_header)
+        if auth:
+            headers.update(auth.get_header())
         request_parameters = {'proxies': self.proxy_dict,
                               'timeout': RequestsTimeout.TIMEOUT_TUPLE}
         request_parameters = {**parameters, **request_parameters}
-        while i < retry:
-            i += 1
+        attempts = RequestAttempts(self.scrape_utility, self.stats, url, retry)
+        while True:
+            self.scrape_utility.wait(url)
+            attempts.start()
             try:
-                self.scrape_utility.wait(url)
                 page = request_method(url, headers=headers, **request_parameters)
-                status_message = 'Status: {status}, {reason} for URL: {url}'.format(status=page.status_code,
-                                                                                    reason=page.reason, url=url)
-                if page.status_code == 200:
-                    return page
-                elif page.status_code == 404:
-                    raise ValueError(status_message)
-                print(" Status code :{status}, Retrying ...".format(status=page.status_code))
             except requests.exceptions.RequestException as e:
-                print(e)
-                time.sleep(self.delay)
-                print("Retrying")
-                print(url)
-                status_message = 'RequestException {reason} for URL: {url}'.format(reason=e, url=url)
-        raise ValueError(status_message)
-
-    def get_request(self, url: str, params=None, retry=5, header=None) -> Response:
-        request_method = requests.get
+                action, sleep_secs = attempts.failed(e)
+            else:
+                action, sleep_secs = attempts.answered(page, auth)
+            if action == RetryPolicy.SUCCESS:
+                return page
+            if action == RetryPolicy.REFRESH:
+                auth.invalidate(headers.get('Authorization'))
+                headers.update(auth.get_header())
+                continue
+            time.sleep(sleep_secs)
+
+    def get_request(self, url: str, params=None, retry=None, header=None, auth=None) -> 'requests.Response':
+        request_method = self.session.get
         request_parameters = {'params': params}
-        return self._make_request(url, request_method, parameters=request_parameters, retry=retry, header=header)
+        return self._make_request(url, request_method, parameters=request_parameters, retry=retry, header=header,
+                                  auth=auth)
 
-    def post_request(self, url: str, json=None, retry=5, header=None) -> Response:
-        request_method = requests.post
+    def post_request(self, url: str, json=None, retry=None, header=None, auth=None) -> 'requests.Response':
+        request_method = self.session.post
         request_parameters = {'data': json}
-        return self._make_request(url, request_method, parameters=request_parameters, retry=retry, header=header)
+        return self._make_request(url, request_method, parameters=request_parameters, retry=retry, header=header,
+                                  auth=auth)
 
     def activate_proxy(self, host, port, username, password) -> Dict:
         proxy = 'http://{}:{}@{}:{}'.format(username, password, host, port)
         self.proxy_dict = {'http': proxy,
                            'https': proxy}
         return self.proxy_dict
+
+
+class AsyncResponse:
+    """ The parts of a `requests.Response` callers use, read from an aiohttp response"""
+
+    def __init__(self, status_code, reason, headers, content):
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return JSONCodec.loads(self.content)
+
+
+class AsyncRequestMaker:
+    """
+    Coroutine counterpart of RequestMaker, with the same retry and rate
+    limiting behaviour, but sleeping without blocking the event loop and
+    sending through one pooled aiohttp session.
+    Use as `async with AsyncRequestMaker() as request_maker`.
+    """
+
+    def __init__(self, header=None, delay=10, rate_limiter=None, pool_size=SessionPool.DEFAULT_POOL_SIZE,
+                 retry_policy=None, user_agent_provider=None):
+        self.delay = delay
+        self.scrape_utility = WebScraperUtility(delay=delay, rate_limiter=rate_limiter, retry_policy=retry_policy,
+                                                user_agent_provider=user_agent_provider)
+        self.stats = RequestStats()
+        self.proxy = None
+        self.extra_header = header if header else {}
+        self.pool_size = pool_size
+        self.session = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.pool_size)
+        timeout = aiohttp.ClientTimeout(sock_connect=RequestsTimeout.CONNECTION_TIMEOUT,
+                                        sock_read=RequestsTimeout.READ_TIMEOUT)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                             headers={'Accept-Encoding': 'gzip, deflate'})
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        await self.session.close()
+        self.session = None
+
+    async def _make_request(self, url, request_method, parameters, retry, header=None, auth=None):
+        """ RequestMaker._make_request, `auth` provides `get_header_async(request_maker)` instead of `get_header()`"""
+        headers = self.scrape_utility.get_headers(header if header else self.extra_header)
+        if auth:
+            headers.update(await auth.get_header_async(self))
+        attempts = RequestAttempts(self.scrape_utility, self.stats, url, retry)
+        while True:
+            await self.scrape_utility.wait_async(url)
+            attempts.start()
+            try:
+                async with self.session.request(request_method, url, headers=headers, proxy=self.proxy,
+                                                **parameters) as page:
+                    content = await page.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                action, sleep_secs = attempts.failed(e)
+            else:
+                page = AsyncResponse(page.status, page.reason, page.headers, content)
+                action, sleep_secs = attempts.answered(page, auth)
+            if action == RetryPolicy.SUCCESS:
+                return page
+            if action == RetryPolicy.REFRESH:
+                auth.invalidate(headers.get('Authorization'))
+                headers.update(await auth.get_header_async(self))
+                continue
+            await asyncio.sleep(sleep_secs)
+
+    async def get_request(self, url: str, params=None, retry=None, header=None, auth=None) -> AsyncResponse:
+        request_parameters = {'params': params}
+        return await self._make_request(url, 'GET', parameters=request_parameters, retry=retry, header=header,
+                                        auth=auth)
+
+    async def post_request(self, url: str, json=None, retry=None, header=None, auth=None) -> AsyncResponse:
+        request_parameters = {'data': json}
+        return await self._make_request(url, 'POST', parameters=request_parameters, retry=retry, header=header,
+                                        auth=auth)
+
+    def activate_proxy(self, host, port, username, password):
+        self.proxy = 'http://{}:{}@{}:{}'.format(username, password, host, port)
+        return self.proxy
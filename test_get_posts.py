@@ -0,0 +1,54 @@
+import os
+import shutil
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+
+from benchmark import MockSocialStudioAPI
+from get_posts import FileComponents, PostExtractor, StarTVClient, TokenGenerator
+from post_store import PostIndex, PostSink
+from request_maker import RequestMaker
+from utils import JSONUtils
+
+PROFILE_ID = '1000000'
+
+
+class PostExtractorRollbackTest(unittest.TestCase):
+    def setUp(self):
+        self.current_dir = os.getcwd()
+        self.work_dir = tempfile.mkdtemp(prefix='test_get_posts_')
+        os.chdir(self.work_dir)
+        JSONUtils.write_json_data_to_file('credentials.json', {'client_id': 'test', 'client_secret': 'test',
+                                                               'username': 'test', 'password': 'test'})
+        self.api = MockSocialStudioAPI(posts_per_profile=3500)
+        self.base_url = self.api.start()
+
+    def tearDown(self):
+        self.api.stop()
+        os.chdir(self.current_dir)
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def test_posts_lost_with_unsynced_pages_are_fetched_again(self):
+        self._extract()
+        file_components = FileComponents(PROFILE_ID)
+        sink_files = (file_components.sink_with_content, file_components.sink_without_content)
+        # Losing the data written since the last fsync leaves the sinks shorter than the committed state.
+        for sink_file in sink_files:
+            with open(sink_file, 'r+') as file:
+                file.truncate(os.path.getsize(sink_file) // 2)
+        self._extract()
+        post_ids = [post['id'] for sink_file in sink_files for post in PostSink(sink_file).iter_posts()]
+        self.assertEqual(len(post_ids), 3500)
+        self.assertEqual(len(set(post_ids)), 3500)
+        self.assertEqual(len(PostIndex(file_components.index_file)), 3500)
+
+    def _extract(self):
+        request_maker = RequestMaker(delay=0)
+        token_generator = TokenGenerator(client_info=StarTVClient(), request_maker=request_maker,
+                                         base_url=self.base_url)
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            PostExtractor(token_generator, request_maker=request_maker, fsync_every=4).write_api_data(PROFILE_ID)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import io
+import json
+import unittest
+
+from utils import JSONStreamReader
+
+DOCUMENT = {
+    'meta': {'totalCount': 3},
+    'ratio': -2.5e10,
+    'data': [
+        {'id': 1, 'score': 12.75, 'topics': [101, 202], 'title': 'café ☃', 'flags': [True, False, None]},
+        {'id': 22, 'score': -0.125, 'topics': [], 'title': 'a "quoted" title', 'nested': {'values': [1e-3, 4E+2]}},
+        {'id': 333, 'score': 7, 'topics': [303], 'title': ''}
+    ],
+    'scores': [12.75, -0.125, 1e-3, 4E+2, 7, 0, -12345678901234567890]
+}
+
+
+class JSONStreamReaderTest(unittest.TestCase):
+    def test_numbers_split_across_chunks(self):
+        self.assertEqual(self._read('{"data":[1.5]}', 1), [1.5])
+        for chunk_size in (1, 2, 3, 7):
+            self.assertEqual(self._read('{"meta": -2.5e10, "data": [1]}', chunk_size), [1])
+
+    def test_small_chunks_match_json_loads(self):
+        for text in (json.dumps(DOCUMENT), json.dumps(DOCUMENT, indent=2), json.dumps(DOCUMENT, separators=(',', ':'))):
+            for chunk_size in range(1, 12):
+                self.assertEqual(self._read(text, chunk_size), DOCUMENT['data'])
+                self.assertEqual(self._read(text, chunk_size, 'scores'), DOCUMENT['scores'])
+
+    def test_missing_and_empty_arrays(self):
+        self.assertEqual(self._read('{}', 1), [])
+        self.assertEqual(self._read('{"data": []}', 1), [])
+        self.assertEqual(self._read('{"meta": {"totalCount": 0}}', 2), [])
+
+    @staticmethod
+    def _read(text, chunk_size, key='data'):
+        return list(JSONStreamReader(io.StringIO(text), chunk_size=chunk_size).iter_object_array(key))
+
+
+if __name__ == '__main__':
+    unittest.main()
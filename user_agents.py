@@ -0,0 +1,74 @@
+import random
+import threading
+
+# Current desktop browsers, bundled so picking a user agent needs neither network nor a browser database.
+USER_AGENTS = (
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
+    'Chrome/124.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
+    'Chrome/123.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) '
+    'Chrome/124.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) '
+    'Chrome/124.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
+    'Chrome/124.0.0.0 Safari/537.36 Edg/124.0.2478.67',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:125.0) Gecko/20100101 Firefox/125.0',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:124.0) Gecko/20100101 Firefox/124.0',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:125.0) Gecko/20100101 Firefox/125.0',
+    'Mozilla/5.0 (X11; Linux x86_64; rv:125.0) Gecko/20100101 Firefox/125.0',
+    'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:125.0) Gecko/20100101 Firefox/125.0',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) '
+    'Version/17.4.1 Safari/605.1.15',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) '
+    'Version/17.3.1 Safari/605.1.15',
+)
+
+
+class UserAgentProvider:
+    """
+    Hands out the User-Agent header of a request from an in-memory list.
+    ROTATE picks a random user agent per request, PIN keeps the one picked
+    when the provider was created. Request makers share `get_default()`, so
+    the list is loaded once per process.
+    """
+    ROTATE = 'rotate'
+    PIN = 'pin'
+
+    _default = None
+    _lock = threading.Lock()
+
+    def __init__(self, user_agents=USER_AGENTS, strategy=ROTATE):
+        if strategy not in (self.ROTATE, self.PIN):
+            raise ValueError('Unknown user agent strategy: {}'.format(strategy))
+        if not user_agents:
+            raise ValueError('No user agents given')
+        self.strategy = strategy
+        # Built once, callers copy the header into their own dict.
+        self.headers = [{'User-Agent': user_agent} for user_agent in user_agents]
+        self.pinned_header = random.choice(self.headers)
+
+    def get_header(self):
+        if self.strategy == self.PIN:
+            return self.pinned_header
+        return random.choice(self.headers)
+
+    @staticmethod
+    def from_file(user_agents_file, strategy=ROTATE):
+        """ Provider for a file holding one user agent per line"""
+        with open(user_agents_file) as file:
+            user_agents = [line.strip() for line in file if line.strip() and not line.startswith('#')]
+        return UserAgentProvider(user_agents, strategy=strategy)
+
+    @staticmethod
+    def get_default():
+        with UserAgentProvider._lock:
+            if UserAgentProvider._default is None:
+                UserAgentProvider._default = UserAgentProvider()
+            return UserAgentProvider._default
+
+    @staticmethod
+    def set_default(provider):
+        """ Make `provider` the one used by request makers created without their own"""
+        with UserAgentProvider._lock:
+            UserAgentProvider._default = provider
@@ -1,26 +1,46 @@
+import importlib
 import json
 import os
 import shutil
-from collections import defaultdict
-from genericpath import isfile, isdir
-from os import listdir
+import time
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from fnmatch import fnmatch
+from genericpath import isfile
 from os.path import join, basename, normpath
 from shutil import rmtree, copyfile
 from typing import List
 
+try:
+    import orjson
+except ImportError:
+    # Optional, JSONCodec falls back to the stdlib json module.
+    orjson = None
+
+
+class LazyModule:
+    """
+    Stands in for a module that is only imported when one of its attributes is
+    first used, e.g. `requests = LazyModule('requests')`, so importing our
+    modules stays cheap for callers that never send a request.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attribute):
+        # Only called for attributes of the real module, `name` and `module` are found normally.
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attribute)
+
 
 class OSFileOperations:
     @staticmethod
-    def get_all_files(path, recursive=True):
-        files = []
-        for file_name in listdir(path):
-            file_path = join(path, file_name)
-            if isfile(file_path):
-                files.append(file_path)
-            elif isdir(file_path):
-                if recursive:
-                    files += OSFileOperations.get_all_files(file_path)
-        return files
+    def get_all_files(path, recursive=True, workers=None):
+        return list(OSFileOperations.iter_files(path, recursive=recursive, workers=workers))
 
     @staticmethod
     def get_all_csv_files(path, recursive=True):
@@ -29,17 +49,66 @@ class OSFileOperations:
         return files
 
     @staticmethod
-    def get_all_dirs(path, recursive=True):
-        dirs = []
-        for dir_path in listdir(path):
-            dir_path = join(path, dir_path)
-            if isfile(dir_path):
-                continue
-            elif isdir(dir_path):
-                dirs.append(dir_path)
-                if recursive:
-                    dirs += OSFileOperations.get_all_dirs(dir_path)
-        return dirs
+    def get_all_dirs(path, recursive=True, workers=None):
+        return list(OSFileOperations.iter_dirs(path, recursive=recursive, workers=workers))
+
+    @staticmethod
+    def iter_files(path, recursive=True, workers=None):
+        for entry in OSFileOperations.iter_entries(path, recursive=recursive, workers=workers):
+            if entry.is_file():
+                yield entry.path
+
+    @staticmethod
+    def iter_dirs(path, recursive=True, workers=None):
+        for entry in OSFileOperations.iter_entries(path, recursive=recursive, workers=workers):
+            if entry.is_dir():
+                yield entry.path
+
+    @staticmethod
+    def iter_entries(path, recursive=True, workers=None):
+        """
+        Yield the os.DirEntry objects below `path` lazily, each directory
+        followed by its contents. Entries carry their type from the directory
+        listing, so telling files from directories needs no stat call on most
+        filesystems. With `workers`, the subdirectories of `path` are walked
+        concurrently by that many threads, in the same order.
+        """
+        if not recursive or not workers or workers < 2:
+            yield from OSFileOperations._walk_entries(path, recursive)
+            return
+        with os.scandir(path) as entries:
+            top_entries = list(entries)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Subdirectories are walked at most 2 * workers entries ahead of the one being yielded.
+            pending = deque()
+            for entry in top_entries:
+                subtree = executor.submit(OSFileOperations._list_entries, entry.path) if entry.is_dir() else None
+                pending.append((entry, subtree))
+                if len(pending) > 2 * workers:
+                    yield from OSFileOperations._pop_entries(pending)
+            while pending:
+                yield from OSFileOperations._pop_entries(pending)
+
+    @staticmethod
+    def _walk_entries(path, recursive=True):
+        with os.scandir(path) as entries:
+            # Listed up front, so no directory handle stays open while the caller consumes a subtree.
+            entries = list(entries)
+        for entry in entries:
+            yield entry
+            if recursive and entry.is_dir():
+                yield from OSFileOperations._walk_entries(entry.path)
+
+    @staticmethod
+    def _list_entries(path):
+        return list(OSFileOperations._walk_entries(path))
+
+    @staticmethod
+    def _pop_entries(pending):
+        entry, subtree = pending.popleft()
+        yield entry
+        if subtree is not None:
+            yield from subtree.result()
 
     @staticmethod
     def get_base_name(path):
@@ -70,13 +139,8 @@ class OSFileOperations:
 
     @staticmethod
     def get_all_sub_directories(directory_path: str) -> List[str]:
-        sub_directories = list()
-        files_and_folder_names = os.listdir(directory_path)
-        for item in files_and_folder_names:
-            path = '{}{}'.format(directory_path, item)
-            if os.path.isdir(path):
-                sub_directories.append(item)
-        return sub_directories
+        with os.scandir(directory_path) as entries:
+            return [entry.name for entry in entries if entry.is_dir()]
 
     @staticmethod
     def copy_file(source_file_path, destination):
@@ -111,18 +175,322 @@ class OSFileOperations:
     def remove_directory(path):
         shutil.rmtree(path)
 
+    @staticmethod
+    def get_file_size(file_path):
+        if not OSFileOperations.entity_exists(file_path):
+            return 0
+        return os.path.getsize(file_path)
+
+    @staticmethod
+    def fsync_file(file_path):
+        if not OSFileOperations.entity_exists(file_path):
+            return
+        with open(file_path, 'rb+') as file:
+            os.fsync(file.fileno())
+
+    @staticmethod
+    def fsync_directory(directory):
+        # Makes a rename inside `directory` durable; directories cannot be opened for this on Windows.
+        if not hasattr(os, 'O_DIRECTORY'):
+            return
+        fd = os.open(directory or '.', os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    @contextmanager
+    def atomic_open(file_path, mode='w', fsync=False, file_mode=None):
+        """
+        Write to a temporary sibling of `file_path` and rename it over `file_path`
+        only once writing succeeded. With `file_mode` (e.g. 0o600) the temporary
+        file is created with those permissions, so the content is never exposed
+        with looser ones.
+        """
+        OSFileOperations.ensure_directory(file_path)
+        temp_path = '{}.tmp.{}'.format(file_path, os.getpid())
+        opener = None
+        if file_mode is not None:
+            # A stale temporary file would keep its own permissions.
+            OSFileOperations.remove_entity(temp_path)
+
+            def opener(path, flags):
+                return os.open(path, flags | os.O_EXCL, file_mode)
+        try:
+            with open(temp_path, mode, opener=opener) as file:
+                yield file
+                if fsync:
+                    file.flush()
+                    os.fsync(file.fileno())
+            os.replace(temp_path, file_path)
+        except BaseException:
+            if OSFileOperations.entity_exists(temp_path):
+                os.remove(temp_path)
+            raise
+        if fsync:
+            OSFileOperations.fsync_directory(OSFileOperations.get_dir_path(file_path))
+
+
+class FileManifest:
+    """
+    Size and mtime of every file below a directory, persisted between runs.
+    `scan` lists again only directories whose mtime changed since the last
+    scan and takes the files of the others from the manifest. Creating,
+    removing or atomically replacing a file changes its directory's mtime,
+    appending to it does not: pass `check_files=True` to also stat the files
+    of unchanged directories, e.g. when NDJSON sinks are scanned.
+    """
+    VERSION = 1
+    # A directory modified this recently may change again within the filesystem's mtime granularity.
+    RACY_NANOSECONDS = 2 * 10 ** 9
+
+    def __init__(self, manifest_file):
+        self.manifest_file = manifest_file
+        self.root = None
+        # directory path -> {'mtime': ns or None, 'files': {name: [size, mtime ns]}, 'dirs': [names]}
+        self.dirs = dict()
+        if OSFileOperations.entity_exists(manifest_file):
+            manifest = JSONUtils.load_json_data_from_file(manifest_file)
+            if manifest.get('version') == self.VERSION:
+                self.root = manifest['root']
+                self.dirs = manifest['dirs']
+
+    @property
+    def files(self):
+        """ file path -> (size, mtime in nanoseconds)"""
+        return {join(dir_path, name): tuple(stat) for dir_path, directory in self.dirs.items()
+                for name, stat in directory['files'].items()}
+
+    def iter_files(self, pattern=None):
+        """ Files of the last scan, optionally only those whose name matches the glob `pattern`"""
+        for dir_path, directory in self.dirs.items():
+            for name in directory['files']:
+                if pattern is None or fnmatch(name, pattern):
+                    yield join(dir_path, name)
+
+    def scan(self, root, workers=None, check_files=False):
+        """
+        Bring the manifest up to date with `root`, scanning directories in a
+        pool of `workers` threads, and return the paths of the files added,
+        modified and removed since the last scan as a dict of lists.
+        """
+        old_files = self.files if self.root == root else dict()
+        old_dirs = self.dirs if self.root == root else dict()
+        scanned_at = time.time_ns()
+        new_dirs = dict()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(self._scan_dir, root, old_dirs.get(root), scanned_at, check_files)}
+            while futures:
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    dir_path, directory = future.result()
+                    new_dirs[dir_path] = directory
+                    for name in directory['dirs']:
+                        sub_dir = join(dir_path, name)
+                        futures.add(executor.submit(self._scan_dir, sub_dir, old_dirs.get(sub_dir), scanned_at,
+                                                    check_files))
+        self.root = root
+        self.dirs = new_dirs
+        new_files = self.files
+        return {'added': [path for path in new_files if path not in old_files],
+                'modified': [path for path, stat in new_files.items() if path in old_files and old_files[path] != stat],
+                'removed': [path for path in old_files if path not in new_files]}
+
+    def save(self):
+        JSONUtils.write_json_data_to_file(self.manifest_file, {'version': self.VERSION, 'root': self.root,
+                                                               'dirs': self.dirs})
+
+    def _scan_dir(self, dir_path, old_directory, scanned_at, check_files):
+        mtime = os.stat(dir_path).st_mtime_ns
+        if scanned_at - mtime < self.RACY_NANOSECONDS:
+            # Listed now, but not trusted by the next scan.
+            mtime = None
+        elif old_directory is not None and old_directory['mtime'] == mtime:
+            if not check_files:
+                return dir_path, old_directory
+            files = self._stat_files(dir_path, old_directory['files'])
+            if files is not None:
+                return dir_path, {'mtime': mtime, 'files': files, 'dirs': old_directory['dirs']}
+        files, dirs = dict(), []
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    dirs.append(entry.name)
+                elif entry.is_file():
+                    stat = entry.stat()
+                    files[entry.name] = [stat.st_size, stat.st_mtime_ns]
+        return dir_path, {'mtime': mtime, 'files': files, 'dirs': dirs}
+
+    @staticmethod
+    def _stat_files(dir_path, names):
+        """ Current [size, mtime] of the files `names`, None if one of them is gone"""
+        files = dict()
+        for name in names:
+            try:
+                stat = os.stat(join(dir_path, name))
+            except FileNotFoundError:
+                return None
+            files[name] = [stat.st_size, stat.st_mtime_ns]
+        return files
+
+
+class JSONStreamReader:
+    """
+    Incremental reader for one large JSON document, decoding a value at a time
+    from a text file so that only the current value has to fit in memory.
+    """
+    WHITESPACE = ' \t\r\n'
+
+    def __init__(self, file, chunk_size=1 << 20):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.position = 0
+
+    def iter_object_array(self, key):
+        """ Yield the items of the array stored under `key` of the top level object"""
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        while True:
+            name = self.decode_value()
+            self._expect(':')
+            if name == key:
+                yield from self._iter_array()
+            else:
+                self.decode_value()
+            if self._next_char() == '}':
+                return
+
+    def decode_value(self):
+        self._skip_whitespace()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                # The value continues in the next chunk.
+                if not self._fill():
+                    raise
+                continue
+            if self._may_continue(value, end) and self._fill():
+                continue
+            self.position = end
+            return value
+
+    def _may_continue(self, value, end):
+        # A number cut by the end of the buffer decodes as its prefix, e.g. '1.' as 1 or '-2.5e' as -2.5.
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            return False
+        return end == len(self.buffer) or self.buffer[end] not in self.WHITESPACE + ',]}'
+
+    def _iter_array(self):
+        self._expect('[')
+        if self._peek() == ']':
+            self.position += 1
+            return
+        while True:
+            yield self.decode_value()
+            if self._next_char() == ']':
+                return
+
+    def _next_char(self):
+        char = self._peek()
+        if char not in ',]}':
+            raise ValueError('Unexpected {!r} at offset {} of the JSON document'.format(char, self.position))
+        self.position += 1
+        return char
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError('Expected {!r} at offset {} of the JSON document'.format(char, self.position))
+        self.position += 1
+
+    def _peek(self):
+        self._skip_whitespace()
+        if self.position < len(self.buffer):
+            return self.buffer[self.position]
+        return ''
+
+    def _skip_whitespace(self):
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in self.WHITESPACE:
+                self.position += 1
+            if self.position < len(self.buffer) or not self._fill():
+                return
+
+    def _fill(self):
+        chunk = self.file.read(self.chunk_size)
+        if not chunk:
+            return False
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
+
+
+class JSONCodec:
+    """
+    JSON encoding of the whole project, from and to bytes: orjson when it is
+    installed, the stdlib json module otherwise. Both backends write compact
+    UTF-8, so files do not change with the backend that wrote them.
+    """
+    if orjson is not None:
+        BACKEND = 'orjson'
+
+        @staticmethod
+        def loads(data):
+            return orjson.loads(data)
+
+        @staticmethod
+        def dumps(obj):
+            # Counters keyed by status code have int keys, which the stdlib turns into strings too.
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    else:
+        BACKEND = 'json'
+
+        @staticmethod
+        def loads(data):
+            return json.loads(data)
+
+        @staticmethod
+        def dumps(obj):
+            return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
 
 class JSONUtils:
     @staticmethod
-    def write_json_data_to_file(file, data_dict):
-        OSFileOperations.ensure_directory(file)
-        with open(file, 'w') as outfile:
-            json.dump(data_dict, outfile)
+    def write_json_data_to_file(file, data_dict, fsync=False, file_mode=None):
+        with OSFileOperations.atomic_open(file, mode='wb', fsync=fsync, file_mode=file_mode) as outfile:
+            outfile.write(JSONCodec.dumps(data_dict))
 
     @staticmethod
     def load_json_data_from_file(input_file, default_dict=False, defaultdict_type=dict):
-        with open(input_file) as file:
-            data_dict = json.load(file)
+        with open(input_file, 'rb') as file:
+            data_dict = JSONCodec.loads(file.read())
             if default_dict:
                 return defaultdict(defaultdict_type, data_dict)
             return data_dict
+
+    @staticmethod
+    def iter_json_array_items(input_file, key='data'):
+        with open(input_file, encoding='utf-8') as file:
+            yield from JSONStreamReader(file).iter_object_array(key)
+
+    @staticmethod
+    def append_json_lines(file, records, fsync=False):
+        OSFileOperations.ensure_directory(file)
+        with open(file, 'ab') as outfile:
+            for record in records:
+                outfile.write(JSONCodec.dumps(record))
+                outfile.write(b'\n')
+            if fsync:
+                outfile.flush()
+                os.fsync(outfile.fileno())
+
+    @staticmethod
+    def iter_json_lines(input_file):
+        with open(input_file, 'rb') as file:
+            for line in file:
+                if line.strip():
+                    yield JSONCodec.loads(line)